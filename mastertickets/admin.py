@@ -0,0 +1,228 @@
+# Copyright (c) 2012 Aleksey A. Porfirov
+
+import csv
+import json
+import sys
+
+from trac.admin import IAdminCommandProvider, AdminCommandError
+from trac.core import *
+from trac.util.text import printout
+
+from model import CHUNK_SIZE, placeholders
+from api import MasterTicketsSystem
+
+
+class MasterTicketsAdmin(Component):
+    """trac-admin commands for the MasterTickets plugin."""
+
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider methods
+
+    def get_admin_commands(self):
+        yield ('mastertickets resync', '[--dry-run] [--project <id>]',
+               """Rebuild blocking and blockedby fields from ticket links
+
+               Recompute the values of the `blocking` and `blockedby`
+               custom fields from the mastertickets table and write back
+               the ones which differ. Tickets are processed in chunks,
+               each chunk is committed separately.
+
+               With --dry-run, only report differences. With --project,
+               only process tickets of the given project.
+               """,
+               None, self._do_resync)
+        yield ('mastertickets import',
+               '[--dry-run] [--format csv|json] [--author <name>] [--comment <text>] <file>',
+               """Add and remove ticket links in bulk
+
+               Read links from <file> ("-" for standard input). In csv
+               format every row is `source,dest[,action]`, in json
+               format every line is an object with `source`, `dest` and
+               optional `action` keys (JSON Lines). Source is the
+               blocking ticket, action is `add` (default) or `remove`.
+               The format is guessed from the file extension by default.
+
+               The whole batch is checked for missing tickets and
+               circular dependencies and then applied in one
+               transaction. With --dry-run, only check the batch.
+               """,
+               None, self._do_import)
+
+    def _do_resync(self, *args):
+        dry_run = False
+        pid = None
+        args = list(args)
+        while args:
+            arg = args.pop(0)
+            if arg == '--dry-run':
+                dry_run = True
+            elif arg == '--project' and args:
+                try:
+                    pid = int(args.pop(0))
+                except ValueError:
+                    raise AdminCommandError('Invalid project id')
+            else:
+                raise AdminCommandError('Invalid argument "%s"' % arg)
+
+        db = self.env.get_db_cnx()
+        cursor = db.cursor()
+        fixed = checked = 0
+        last_id = 0
+        while True:
+            if pid is None:
+                cursor.execute('SELECT id FROM ticket WHERE id>%s ORDER BY id LIMIT %s',
+                               (last_id, CHUNK_SIZE))
+            else:
+                cursor.execute('SELECT id FROM ticket WHERE id>%s AND project_id=%s '
+                               'ORDER BY id LIMIT %s', (last_id, pid, CHUNK_SIZE))
+            ids = [int(row[0]) for row in cursor]
+            if not ids:
+                break
+            last_id = ids[-1]
+            checked += len(ids)
+            in_ids = placeholders(len(ids))
+
+            expected = {} # {(ticket, field): set of linked ids}
+            for tkt_id in ids:
+                expected[(tkt_id, 'blocking')] = set()
+                expected[(tkt_id, 'blockedby')] = set()
+            cursor.execute('SELECT source, dest FROM mastertickets WHERE source IN (%s)'
+                           % in_ids, ids)
+            for source, dest in cursor:
+                expected[(int(source), 'blocking')].add(int(dest))
+            cursor.execute('SELECT source, dest FROM mastertickets WHERE dest IN (%s)'
+                           % in_ids, ids)
+            for source, dest in cursor:
+                expected[(int(dest), 'blockedby')].add(int(source))
+
+            stored = {}
+            cursor.execute("""
+                SELECT ticket, name, value FROM ticket_custom
+                WHERE name IN ('blocking', 'blockedby') AND ticket IN (%s)
+                """ % in_ids, ids)
+            for tkt_id, field, value in cursor:
+                stored[(int(tkt_id), field)] = value or ''
+
+            to_update = []
+            to_insert = []
+            for key in sorted(expected):
+                tkt_id, field = key
+                value = ', '.join(str(n) for n in sorted(expected[key]))
+                old_value = stored.get(key)
+                if (old_value or '') == value:
+                    continue
+                if dry_run:
+                    printout('#%s %s: "%s" -> "%s"' % (tkt_id, field, old_value or '', value))
+                if old_value is None:
+                    to_insert.append((tkt_id, field, value))
+                else:
+                    to_update.append((value, tkt_id, field))
+            fixed += len(to_update) + len(to_insert)
+
+            if dry_run:
+                continue
+            if to_update:
+                cursor.executemany('UPDATE ticket_custom SET value=%s WHERE ticket=%s AND name=%s',
+                                   to_update)
+            if to_insert:
+                cursor.executemany('INSERT INTO ticket_custom (ticket, name, value) VALUES (%s, %s, %s)',
+                                   to_insert)
+            db.commit()
+
+        if dry_run:
+            printout('%d tickets checked, %d fields would be updated' % (checked, fixed))
+        else:
+            printout('%d tickets checked, %d fields updated' % (checked, fixed))
+
+    def _do_import(self, *args):
+        dry_run = False
+        format = None
+        author = 'trac'
+        comment = ''
+        args = list(args)
+        filename = None
+        while args:
+            arg = args.pop(0)
+            if arg == '--dry-run':
+                dry_run = True
+            elif arg in ('--format', '--author', '--comment') and args:
+                value = args.pop(0)
+                if arg == '--format':
+                    if value not in ('csv', 'json'):
+                        raise AdminCommandError('Unknown format "%s"' % value)
+                    format = value
+                elif arg == '--author':
+                    author = value
+                else:
+                    comment = value
+            elif filename is None:
+                filename = arg
+            else:
+                raise AdminCommandError('Invalid argument "%s"' % arg)
+        if filename is None:
+            raise AdminCommandError('No input file given')
+        if format is None:
+            format = filename.lower().endswith(('.json', '.jsonl')) and 'json' or 'csv'
+
+        to_add = set()
+        to_remove = set()
+        if filename == '-':
+            f = sys.stdin
+        else:
+            f = open(filename, 'rb')
+        try:
+            for action, source, dest in self._read_links(f, format):
+                if action == 'remove':
+                    to_remove.add((source, dest))
+                    to_add.discard((source, dest))
+                else:
+                    to_add.add((source, dest))
+                    to_remove.discard((source, dest))
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+        mt_system = MasterTicketsSystem(self.env)
+        if dry_run:
+            added, removed = mt_system.check_links_bulk(to_add, to_remove)
+            printout('%d links would be added, %d removed' % (len(added), len(removed)))
+        else:
+            added, removed = mt_system.set_links_bulk(to_add, to_remove, author, comment)
+            printout('%d links added, %d removed' % (added, removed))
+
+    def _read_links(self, f, format):
+        """Iterate over `(action, source, dest)` records read from `f`."""
+        if format == 'json':
+            rows = self._read_json_rows(f)
+        else:
+            rows = csv.reader(f)
+        for lineno, row in enumerate(rows):
+            if not row or not ''.join(unicode(v) for v in row).strip():
+                continue
+            try:
+                source, dest = int(row[0]), int(row[1])
+            except (TypeError, ValueError, IndexError):
+                if lineno == 0 and format == 'csv':
+                    continue # header row
+                raise AdminCommandError('Invalid link record on line %d' % (lineno + 1))
+            action = len(row) > 2 and (row[2] or '').strip().lower() or 'add'
+            if action not in ('add', 'remove'):
+                raise AdminCommandError('Invalid action "%s" on line %d' % (action, lineno + 1))
+            yield action, source, dest
+
+    def _read_json_rows(self, f):
+        for lineno, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                yield None
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise AdminCommandError('Invalid JSON on line %d' % (lineno + 1))
+            if isinstance(record, dict):
+                record = [record.get('source'), record.get('dest'), record.get('action')]
+            elif not isinstance(record, list):
+                raise AdminCommandError('Invalid link record on line %d' % (lineno + 1))
+            yield record
@@ -3,6 +3,8 @@
 # Copyright (c) 2012 Aleksey A. Porfirov
 
 import re
+import weakref
+from itertools import chain
 
 from trac.core import *
 from trac.env import IEnvironmentSetupParticipant
@@ -14,8 +16,8 @@ from trac.web import chrome
 from trac.util.translation import domain_functions
 
 import db_default
-from model import TicketLinks
-from trac.ticket.model import Ticket
+from model import TicketLinks, LinkGraph, CHUNK_SIZE, chunked, find_path, \
+                  is_reachable, placeholders, rebuild_closure, update_links
 
 
 _, tag_, N_, add_domain = \
@@ -30,10 +32,14 @@ class MasterTicketsSystem(Component):
     
     NUMBERS_RE = re.compile(r'\d+', re.U)
 
+    LINK_FIELDS = ('blocking', 'blockedby')
+
     def __init__(self):
         import pkg_resources
         locale_dir = pkg_resources.resource_filename(__name__, 'locale')
         add_domain(self.env.path, locale_dir)
+        # {ticket: {'raw': field values, 'ids': {field: [id, ...]}, 'links': TicketLinks}}
+        self._parsed_links = weakref.WeakKeyDictionary()
 
     # IEnvironmentSetupParticipant methods
     def environment_created(self):
@@ -64,45 +70,37 @@ class MasterTicketsSystem(Component):
         db_manager, _ = DatabaseManager(self.env)._get_connector()
                 
         # Insert the default table
-        old_data = {} # {table_name: (col_names, [row, ...]), ...}
         cursor = db.cursor()
+        old_tables = []
         if not self.found_db_version:
             cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",(db_default.name, db_default.version))
         else:
             cursor.execute("UPDATE system SET value=%s WHERE name=%s",(db_default.version, db_default.name))
+            # Move old data aside, it is copied back once tables are recreated
             for tbl in db_default.tables:
-                try:
-                    cursor.execute('SELECT * FROM %s'%tbl.name)
-                    old_data[tbl.name] = ([d[0] for d in cursor.description], cursor.fetchall())
-                except Exception, e:
-                    if 'OperationalError' not in e.__class__.__name__:
-                        raise e # If it is an OperationalError, keep going
-                try:
-                    cursor.execute('DROP TABLE %s'%tbl.name)
-                except Exception, e:
-                    if 'OperationalError' not in e.__class__.__name__:
-                        raise e # If it is an OperationalError, just move on to the next table
+                if db_default.table_versions.get(tbl.name, 1) > self.found_db_version:
+                    continue # Table does not exist yet
+                cursor.execute('CREATE TABLE %s_old AS SELECT * FROM %s' % (tbl.name, tbl.name))
+                cursor.execute('DROP TABLE %s' % tbl.name)
+                old_tables.append(tbl)
 
+        migrations = []
         for vers, migration in db_default.migrations:
             if self.found_db_version in vers:
                 self.log.info('MasterTicketsSystem: Running migration %s', migration.__doc__)
-                migration(old_data)          
-                
+                migrations.append(migration)
+
         for tbl in db_default.tables:
             for sql in db_manager.to_sql(tbl):
                 cursor.execute(sql)
-                    
-            # Try to reinsert any old data
-            if tbl.name in old_data:
-                data = old_data[tbl.name]
-                sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
-                      (tbl.name, ','.join(data[0]), ','.join(['%s'] * len(data[0])))
-                for row in data[1]:
-                    try:
-                        cursor.execute(sql, row)
-                    except Exception, e:
-                        if 'OperationalError' not in e.__class__.__name__:
-                            raise e
+
+        for tbl in old_tables:
+            self._copy_old_data(db, tbl, migrations)
+            cursor.execute('DROP TABLE %s_old' % tbl.name)
+
+        if 'mastertickets_closure' not in [tbl.name for tbl in old_tables]:
+            self.log.info('MasterTicketsSystem: Building transitive closure of ticket links')
+            rebuild_closure(self.env, db)
 
         custom = self.config['ticket-custom']
         config_dirty = False
@@ -123,13 +121,15 @@ class MasterTicketsSystem(Component):
 
     def ticket_changed(self, tkt, comment, author, old_values):
         db = self.env.get_db_cnx()
-        links = self._prepare_links(tkt, db)
+        links = self.prepare_links(tkt, db)
         links.save(author, comment, tkt.time_changed, db)
         db.commit()
+        self._parsed_links.pop(tkt, None)
 
     def ticket_deleted(self, tkt):
         db = self.env.get_db_cnx()
         
+        # the ticket row is already gone, read its links directly
         links = TicketLinks(self.env, tkt, db)
         links.blocking = set()
         links.blocked_by = set()
@@ -145,44 +145,210 @@ class MasterTicketsSystem(Component):
         db = self.env.get_db_cnx()
         cursor = db.cursor()
         
-        links = self._prepare_links(ticket, db)
+        links = self.prepare_links(ticket, db)
         
         # Check that ticket does not have itself as a blocker 
         if ticket.id in links.blocking | links.blocked_by:
             yield 'blockedby', _('This ticket is blocking itself')
             return
 
-        # Check that there aren't any blocked_by in blocking or their parents
-        blocking = links.blocking.copy()
-        while len(blocking) > 0:
-            if len(links.blocked_by & blocking) > 0:
-                yield 'blockedby', _('This ticket has circular dependencies')
+        # Check that there aren't any blocked_by in blocking or their parents.
+        # The closure lookup rules out cycles cheaply, the path search only
+        # runs to report an actual cycle.
+        if links.blocked_by & links.blocking or \
+                is_reachable(self.env, links.blocking, links.blocked_by, db):
+            path = find_path(self.env, links.blocking, links.blocked_by, db)
+            if path:
+                if ticket.exists:
+                    path = [ticket.id] + path + [ticket.id]
+                yield 'blockedby', _('This ticket has circular dependencies: %(path)s',
+                                     path=u' \u2192 '.join('#%s' % n for n in path))
                 return
-            new_blocking = set()
-            for link in blocking:
-                tmp_tkt = Ticket(self.env, link)
-                new_blocking |= TicketLinks(self.env, tmp_tkt, db).blocking
-            blocking = new_blocking
-        
-        for field in ('blocking', 'blockedby'):
-            try:
-                ids = self.NUMBERS_RE.findall(ticket[field] or '')
-                if len(ids) != len(set(ids)):
-                    yield field, _('Duplicate ticket IDs found')
-                for id in ids[:]:
-                    cursor.execute('SELECT id FROM ticket WHERE id=%s AND project_id=%s', (id, ticket.pid))
-                    row = cursor.fetchone()
-                    if row is None:
-                        ids.remove(id)
-                        chrome.add_warning(req, 'Ticket ID "%s" was removed from %s list as invalid' % (id, field))
-                ticket[field] = ', '.join(sorted(ids, key=lambda x: int(x)))
-            except Exception, e:
-                self.log.debug('MasterTickets: Error parsing %s "%s": %s', field, ticket[field], e)
-                yield field, _('Not a valid list of ticket IDs')
 
-    # Internal methods
-    def _prepare_links(self, tkt, db):
-        links = TicketLinks(self.env, tkt, db)
-        links.blocking = set(int(n) for n in self.NUMBERS_RE.findall(tkt['blocking'] or ''))
-        links.blocked_by = set(int(n) for n in self.NUMBERS_RE.findall(tkt['blockedby'] or ''))
+        # Check that all referenced tickets exist, with one query per chunk
+        parsed = self._parse_links(ticket)
+        all_ids = set()
+        for ids in parsed['ids'].itervalues():
+            all_ids.update(ids)
+        existing = set()
+        for chunk in chunked(sorted(all_ids)):
+            cursor.execute('SELECT id FROM ticket WHERE project_id=%%s AND id IN (%s)'
+                           % placeholders(len(chunk)), [ticket.pid] + chunk)
+            existing.update(int(row[0]) for row in cursor)
+
+        for field in self.LINK_FIELDS:
+            ids = parsed['ids'][field]
+            if len(ids) != len(set(ids)):
+                yield field, _('Duplicate ticket IDs found')
+            valid_ids = []
+            for id in ids:
+                if id in existing:
+                    valid_ids.append(id)
+                else:
+                    chrome.add_warning(req, 'Ticket ID "%s" was removed from %s list as invalid' % (id, field))
+            if len(valid_ids) != len(ids):
+                self._update_parsed_links(parsed, field, valid_ids)
+            ticket[field] = ', '.join(str(id) for id in sorted(valid_ids))
+        parsed['raw'] = self._raw_links(ticket)
+
+    # Public methods
+    def get_links(self, tkt, db=None):
+        """Return `TicketLinks` of ticket `tkt`."""
+        return TicketLinks(self.env, tkt, db)
+
+    def check_links_bulk(self, edges_to_add, edges_to_remove, db=None):
+        """Validate a batch of link changes.
+
+        `edges_to_add` and `edges_to_remove` are collections of
+        `(source, dest)` pairs, source blocking dest. All tickets must
+        exist and both ends of a link must belong to the same project.
+        The links resulting from the change are checked for cycles with
+        a single pass over the merged graph.
+
+        Raise `TracError` on invalid data, otherwise return the
+        `(to_add, to_remove)` sets of links that actually change.
+        """
+        db = db or self.env.get_read_db()
+        cursor = db.cursor()
+        to_add = set((int(s), int(d)) for s, d in edges_to_add)
+        to_remove = set((int(s), int(d)) for s, d in edges_to_remove) - to_add
+        for source, dest in to_add:
+            if source == dest:
+                raise TracError(_('Ticket #%(id)s can not block itself', id=source))
+
+        tkt_ids = set()
+        for pair in chain(to_add, to_remove):
+            tkt_ids.update(pair)
+        projects = {}
+        for chunk in chunked(sorted(tkt_ids)):
+            cursor.execute('SELECT id, project_id FROM ticket WHERE id IN (%s)'
+                           % placeholders(len(chunk)), chunk)
+            for tkt_id, pid in cursor:
+                projects[int(tkt_id)] = pid
+        missing = tkt_ids - set(projects)
+        if missing:
+            raise TracError(_('Tickets not found: %(ids)s',
+                              ids=', '.join('#%s' % n for n in sorted(missing))))
+        for source, dest in to_add:
+            if projects[source] != projects[dest]:
+                raise TracError(_('Tickets #%(source)s and #%(dest)s belong to different projects',
+                                  source=source, dest=dest))
+
+        current = LinkGraph.load(self.env, db=db)
+        to_add = set(pair for pair in to_add if pair[1] not in current.blocking(pair[0]))
+        to_remove = set(pair for pair in to_remove if pair[1] in current.blocking(pair[0]))
+        if to_add:
+            merged = LinkGraph(chain((pair for pair in current.edges() if pair not in to_remove),
+                                     to_add))
+            cyclic = merged.cyclic_links(sorted(to_add))
+            if cyclic:
+                source, dest = cyclic[0]
+                path = [source] + merged.path(dest, source)
+                raise TracError(_('Link #%(source)s -> #%(dest)s creates circular dependencies: %(path)s',
+                                  source=source, dest=dest,
+                                  path=u' \u2192 '.join('#%s' % n for n in path)))
+        return to_add, to_remove
+
+    def set_links_bulk(self, edges_to_add, edges_to_remove, author, comment=''):
+        """Add and remove many links at once.
+
+        The batch is validated with `check_links_bulk` and applied in one
+        transaction with batched field and `ticket_change` updates.
+        Ticket change listeners are not notified. Return the number of
+        links added and removed.
+        """
+        db = self.env.get_db_cnx()
+        to_add, to_remove = self.check_links_bulk(edges_to_add, edges_to_remove, db)
+        update_links(self.env, to_add, to_remove, author, comment, db=db)
+        db.commit()
+        return len(to_add), len(to_remove)
+
+    def prepare_links(self, tkt, db=None):
+        """Return `TicketLinks` of ticket `tkt` with the links set to the
+        values of its `blocking` and `blockedby` fields."""
+        parsed = self._parse_links(tkt)
+        links = parsed['links']
+        if links is None or links.tkt_id != tkt.id:
+            if tkt.id is None:
+                # not inserted yet, has no links and must not be cached
+                # as the ID is only assigned on insert
+                links = TicketLinks(self.env, tkt, links=((), ()))
+            else:
+                links = self.get_links(tkt, db)
+                parsed['links'] = links
+            links.blocking = set(parsed['ids']['blocking'])
+            links.blocked_by = set(parsed['ids']['blockedby'])
         return links
+
+    # Internal methods
+    def _copy_old_data(self, db, tbl, migrations):
+        """Copy rows of the `<table>_old` backup of `tbl` back into `tbl`.
+
+        Rows are read in key order with keyset pagination and inserted in
+        `CHUNK_SIZE` batches, `migrations` are applied to every batch.
+        The backup gets an index on the key columns first, as `CREATE
+        TABLE AS` does not copy it.
+        """
+        read_cursor = db.cursor()
+        write_cursor = db.cursor()
+        key = list(tbl.key)
+        read_cursor.execute('CREATE INDEX %s_old_key_idx ON %s_old (%s)'
+                            % (tbl.name, tbl.name, ','.join(key)))
+        # (k1, k2, ...) > (%s, %s, ...) for backends without row comparison
+        after_sql = ' OR '.join(
+            '(%s)' % ' AND '.join(['%s=%%s' % k for k in key[:i]] + ['%s>%%s' % key[i]])
+            for i in xrange(len(key)))
+        cols = None
+        last = None
+        while True:
+            if last is None:
+                read_cursor.execute('SELECT * FROM %s_old ORDER BY %s LIMIT %s'
+                                    % (tbl.name, ','.join(key), CHUNK_SIZE))
+            else:
+                args = []
+                for i in xrange(len(key)):
+                    args.extend(last[:i + 1])
+                read_cursor.execute('SELECT * FROM %s_old WHERE %s ORDER BY %s LIMIT %s'
+                                    % (tbl.name, after_sql, ','.join(key), CHUNK_SIZE), args)
+            if cols is None:
+                cols = [d[0] for d in read_cursor.description]
+                key_idx = [cols.index(k) for k in key]
+                sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
+                      (tbl.name, ','.join(cols), placeholders(len(cols)))
+            rows = [list(row) for row in read_cursor]
+            if not rows:
+                break
+            last = [rows[-1][i] for i in key_idx]
+            data = {tbl.name: (cols, rows)}
+            for migration in migrations:
+                migration(data)
+            write_cursor.executemany(sql, data[tbl.name][1])
+
+    def _raw_links(self, tkt):
+        return tuple(tkt[field] or '' for field in self.LINK_FIELDS)
+
+    def _parse_links(self, tkt):
+        """Return ticket IDs parsed from the link fields of `tkt`.
+
+        Results are kept per ticket object while the field values stay
+        the same, so the manipulators and change listeners processing one
+        save share them.
+        """
+        raw = self._raw_links(tkt)
+        parsed = self._parsed_links.get(tkt)
+        if parsed is None or parsed['raw'] != raw:
+            ids = {}
+            for field, value in zip(self.LINK_FIELDS, raw):
+                ids[field] = [int(n) for n in self.NUMBERS_RE.findall(value)]
+            parsed = {'raw': raw, 'ids': ids, 'links': None}
+            self._parsed_links[tkt] = parsed
+        return parsed
+
+    def _update_parsed_links(self, parsed, field, ids):
+        parsed['ids'][field] = ids
+        links = parsed['links']
+        if links is not None:
+            if field == 'blocking':
+                links.blocking = set(ids)
+            else:
+                links.blocked_by = set(ids)
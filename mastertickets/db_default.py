@@ -2,21 +2,40 @@
 # Copyright (c) 2007 Noah Kantrowitz. All rights reserved.
 # Copyright (c) 2012 Aleksey A. Porfirov
 
-from trac.db import Table, Column, ForeignKey
+from trac.db import Table, Column, Index, ForeignKey
 
 name = 'mastertickets'
-version = 3
+version = 5
 tables = [
     Table('mastertickets', key=('source','dest'))[
         Column('source', type='integer'),
         Column('dest', type='integer'),
+        Index(['dest']),
         ForeignKey('source', 'ticket', 'id', on_delete='CASCADE'),
         ForeignKey('dest', 'ticket', 'id', on_delete='CASCADE'),
     ],
+    # Transitive closure of mastertickets: descendant is (indirectly)
+    # blocked by ancestor, depth is the length of the shortest path
+    Table('mastertickets_closure', key=('ancestor','descendant'))[
+        Column('ancestor', type='integer'),
+        Column('descendant', type='integer'),
+        Column('depth', type='integer'),
+        Index(['descendant']),
+        ForeignKey('ancestor', 'ticket', 'id', on_delete='CASCADE'),
+        ForeignKey('descendant', 'ticket', 'id', on_delete='CASCADE'),
+    ],
 ]
 
+# Schema version each table was introduced in
+table_versions = {
+    'mastertickets': 1,
+    'mastertickets_closure': 4,
+}
+
 def convert_to_int(data):
     """Convert both source and dest in the mastertickets table to ints."""
+    if 'mastertickets' not in data:
+        return
     rows = data['mastertickets'][1]
     for i, (n1, n2) in enumerate(rows):
         rows[i] = [int(n1), int(n2)]
@@ -3,7 +3,12 @@
 # Copyright (c) 2007 Noah Kantrowitz. All rights reserved.
 # Copyright (c) 2012 Aleksey A. Porfirov
 
+import json
+import os
+import shutil
 import subprocess
+import tempfile
+import threading
 import itertools
 from collections import OrderedDict
 
@@ -11,6 +16,49 @@ from collections import OrderedDict
 def _format_options(base_string, options):
     return u'%s [%s]'%(base_string, u', '.join([u'%s="%s"'%x for x in options.iteritems()]))
 
+# Size of output chunks read from render processes
+CHUNK_SIZE = 64 * 1024
+
+class RenderTimeout(Exception):
+    """Rendering did not finish in time."""
+
+
+def communicate(proc, input=None, timeout=None):
+    """Like `proc.communicate(input)`, but kill `proc` if it takes more
+    than `timeout` seconds and raise `RenderTimeout`.
+    """
+    if not timeout:
+        return proc.communicate(input)
+    killed = []
+    def kill():
+        killed.append(True)
+        try:
+            proc.kill()
+        except OSError: # already exited
+            pass
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        out, err = proc.communicate(input)
+    finally:
+        timer.cancel()
+    if killed:
+        raise RenderTimeout('Process %s killed after %s seconds' % (proc.pid, timeout))
+    return out, err
+
+
+def unescape(value):
+    """Reverse the quoting of dot attribute values."""
+    return value.replace(u'\\n', u'\n').replace(u'\\"', u'"')
+
+def _feed(f, data):
+    try:
+        f.write(data)
+        f.close()
+    except IOError: # the process exited early
+        pass
+
+
 class Edge(dict):
     """Model for an edge in a dot graph."""
 
@@ -100,6 +148,9 @@ class Cluster(object):
 class Graph(object):
     """A model object for a graphviz digraph."""
 
+    # Names of the pseudo nodes holding default node and edge attributes
+    DEFAULTS = (u'node', u'edge')
+
     def __init__(self, name=u'graph'):
         super(Graph,self).__init__()
         self.name = unicode(name)
@@ -168,6 +219,26 @@ class Graph(object):
         key = unicode(key)
         return key in self._node_map
 
+    def iter_nodes(self):
+        """Yield `(node, cluster)` pairs of all nodes, `cluster` is `None`
+        for nodes outside of clusters. The `node` and `edge` entries of
+        default attributes are skipped."""
+        seen = set(self.DEFAULTS)
+        for cluster in self.clusters.itervalues():
+            for node in cluster.nodes.itervalues():
+                if node.name not in seen:
+                    seen.add(node.name)
+                    yield node, cluster
+        for node in itertools.chain(self.nodes, self._node_map.itervalues()):
+            if node.name not in seen:
+                seen.add(node.name)
+                yield node, None
+
+    def iter_edges(self):
+        """Yield all edges, including those inside clusters."""
+        return itertools.chain(self.edges,
+                               *[cl.edges for cl in self.clusters.itervalues()])
+
     # Render methods
 
     @staticmethod
@@ -211,12 +282,139 @@ class Graph(object):
         lines.append(u'}')
         return u'\n'.join(lines)
 
-    def render(self, dot_path='dot', format='png'):
+    def render(self, dot_path='dot', format='png', timeout=None):
         """Render a dot graph."""
         proc = subprocess.Popen([dot_path, '-T%s'%format], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        out, _ = proc.communicate(unicode(self).encode('utf8'))
+        out, _ = communicate(proc, unicode(self).encode('utf8'), timeout)
         return out
 
+    def iter_render(self, dot_path='dot', format='png', filters=(), timeout=None,
+                    stderr=None):
+        """Render a dot graph, yielding the output in chunks.
+
+        The output of dot is piped through the `filters` commands, whose
+        error output goes to `stderr`. All processes are killed after
+        `timeout` seconds, raising `RenderTimeout`.
+        """
+        procs = []
+        killed = []
+        def kill():
+            killed.append(True)
+            for proc in procs:
+                try:
+                    proc.kill()
+                except OSError: # already exited
+                    pass
+        timer = None
+        try:
+            procs.append(subprocess.Popen([dot_path, '-T%s'%format],
+                                          stdin=subprocess.PIPE, stdout=subprocess.PIPE))
+            for args in filters:
+                procs.append(subprocess.Popen(args, stdin=procs[-1].stdout,
+                                              stdout=subprocess.PIPE, stderr=stderr))
+                # only the filter reads it now, dot gets SIGPIPE if it exits
+                procs[-2].stdout.close()
+            if timeout:
+                timer = threading.Timer(timeout, kill)
+                timer.start()
+            # feed the source from another thread, as the pipeline may
+            # block on its output before reading all of its input
+            feeder = threading.Thread(target=_feed,
+                                      args=(procs[0].stdin, unicode(self).encode('utf8')))
+            feeder.daemon = True
+            feeder.start()
+            out = procs[-1].stdout
+            while True:
+                chunk = out.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+            for proc in procs:
+                proc.wait()
+            if killed:
+                raise RenderTimeout('Render killed after %s seconds' % timeout)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            for proc in procs:
+                if proc.poll() is None: # closed before the end
+                    try:
+                        proc.kill()
+                    except OSError:
+                        pass
+                    proc.wait()
+            if procs:
+                procs[-1].stdout.close()
+
+    def iter_json(self, chunk_size=CHUNK_SIZE):
+        """Yield the graph as UTF-8 encoded JSON in chunks of about
+        `chunk_size` bytes.
+
+        The document is `{"nodes": [...], "edges": [...]}`, each node has
+        `id`, `label`, `color`, `cluster` and `url` keys, each edge has
+        `source` and `target` keys.
+        """
+        encode = json.JSONEncoder(ensure_ascii=False).encode
+        def items():
+            yield u'{"nodes": ['
+            sep = u''
+            for node, cluster in self.iter_nodes():
+                yield sep + encode({
+                    'id': node.name,
+                    'label': unescape(unicode(node.get('label', node.name))),
+                    'color': node.get('fillcolor'),
+                    'cluster': cluster and unescape(unicode(cluster.attributes.get('label', cluster.name))),
+                    'url': node.get('URL'),
+                })
+                sep = u', '
+            yield u'], "edges": ['
+            sep = u''
+            for edge in self.iter_edges():
+                yield sep + encode({'source': edge.source.name, 'target': edge.dest.name})
+                sep = u', '
+            yield u']}'
+        buf = []
+        size = 0
+        for item in items():
+            item = item.encode('utf8')
+            buf.append(item)
+            size += len(item)
+            if size >= chunk_size:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+        if buf:
+            yield ''.join(buf)
+
+    def render_many(self, dot_path='dot', formats=('png', 'cmapx'), timeout=None):
+        """Render a dot graph to several formats with a single layout.
+
+        Return a dict `{format: output}`.
+        """
+        tmpdir = tempfile.mkdtemp(prefix='mastertickets')
+        try:
+            args = [dot_path]
+            filenames = {}
+            for i, format in enumerate(formats):
+                filenames[format] = os.path.join(tmpdir, 'out%d' % i)
+                args += ['-T%s' % format, '-o%s' % filenames[format]]
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE)
+            communicate(proc, unicode(self).encode('utf8'), timeout)
+            outputs = {}
+            for format, filename in filenames.iteritems():
+                try:
+                    f = open(filename, 'rb')
+                except IOError:
+                    outputs[format] = ''
+                    continue
+                try:
+                    outputs[format] = f.read()
+                finally:
+                    f.close()
+            return outputs
+        finally:
+            shutil.rmtree(tmpdir, True)
+
 
 if __name__ == '__main__':
     g = Graph()
@@ -3,115 +3,183 @@
 # Copyright (c) 2012 Aleksey A. Porfirov
 
 import copy
+from array import array
+from bisect import bisect_left
 from datetime import datetime
+from itertools import chain, izip
 
 from trac.ticket.model import Ticket
 from trac.util.compat import set, sorted
+from trac.util import hex_entropy
 from trac.util.datefmt import utc, to_utimestamp
-from trac.util.text import exception_to_unicode
+
+# Maximum number of ticket IDs passed in a single ``IN (...)`` clause
+CHUNK_SIZE = 500
+
+# Depth bound of unlimited recursive walks, guards against link cycles
+MAX_WALK_DEPTH = 1000
+
+# Name of the `system` table entry changed on every link table modification
+GENERATION_KEY = 'mastertickets_generation'
+
+def chunked(seq, size=CHUNK_SIZE):
+    """Split `seq` into lists of at most `size` items."""
+    seq = list(seq)
+    for i in xrange(0, len(seq), size):
+        yield seq[i:i+size]
+
+def placeholders(n):
+    """Return a comma separated list of `n` query parameter placeholders."""
+    return ','.join(['%s'] * n)
+
 
 class TicketLinks(object):
     """A model for the ticket links used MasterTickets."""
 
-    def __init__(self, env, tkt, db=None, ticket_cache=None):
+    def __init__(self, env, tkt, db=None, ticket_cache=None, links=None):
         '''Initialize ticket links
         Use `ticket_cache` (if is not None) to store fetched tickets.
+        If `links` is a `(blocking, blocked_by)` pair of sets, it is used
+        instead of querying the database (see `load_many`).
         '''
         self.env = env
-        if not isinstance(tkt, Ticket):
-            if ticket_cache is not None:
-                tid = int(tkt)
-                if tid not in ticket_cache:
-                    ticket_cache[tid] = Ticket(self.env, tid)
-                tkt = ticket_cache[tid]
-            else:
-                tkt = Ticket(self.env, tkt)
-        self.tkt = tkt
+        self._ticket_cache = ticket_cache
+        if isinstance(tkt, Ticket):
+            self._tkt = tkt
+            self.tkt_id = tkt.id
+        else:
+            # ticket itself is fetched on first access
+            self._tkt = None
+            self.tkt_id = int(tkt)
 
-        db = db or self.env.get_db_cnx()
-        cursor = db.cursor()
+        if links is None:
+            db = db or self.env.get_db_cnx()
+            cursor = db.cursor()
+
+            cursor.execute('SELECT dest FROM mastertickets WHERE source=%s ORDER BY dest', (self.tkt_id,))
+            blocking = [num for num, in cursor]
 
-        cursor.execute('SELECT dest FROM mastertickets WHERE source=%s ORDER BY dest', (self.tkt.id,))
-        self.blocking = set([int(num) for num, in cursor])
+            cursor.execute('SELECT source FROM mastertickets WHERE dest=%s ORDER BY source', (self.tkt_id,))
+            blocked_by = [num for num, in cursor]
+        else:
+            blocking, blocked_by = links
+
+        self.blocking = set([int(num) for num in blocking])
         self._old_blocking = copy.copy(self.blocking)
 
-        cursor.execute('SELECT source FROM mastertickets WHERE dest=%s ORDER BY source', (self.tkt.id,))
-        self.blocked_by = set([int(num) for num, in cursor])
+        self.blocked_by = set([int(num) for num in blocked_by])
         self._old_blocked_by = copy.copy(self.blocked_by)
 
+    @property
+    def tkt(self):
+        if self._tkt is None:
+            ticket_cache = self._ticket_cache
+            if ticket_cache is not None:
+                if self.tkt_id not in ticket_cache:
+                    ticket_cache[self.tkt_id] = Ticket(self.env, self.tkt_id)
+                self._tkt = ticket_cache[self.tkt_id]
+            else:
+                self._tkt = Ticket(self.env, self.tkt_id)
+        return self._tkt
+
+    @classmethod
+    def load_many(cls, env, tkt_ids, db=None, ticket_cache=None):
+        """Load links of several tickets at once.
+
+        Links are fetched with a few chunked ``IN (...)`` queries instead of
+        two queries per ticket. Return a dict `{tkt_id: TicketLinks}`.
+        """
+        ids = sorted(set(int(i) for i in tkt_ids))
+        blocking = dict((i, []) for i in ids)
+        blocked_by = dict((i, []) for i in ids)
+        if ids:
+            db = db or env.get_db_cnx()
+            cursor = db.cursor()
+            for chunk in chunked(ids):
+                cursor.execute('SELECT source, dest FROM mastertickets WHERE source IN (%s)'
+                               % placeholders(len(chunk)), chunk)
+                for source, dest in cursor:
+                    blocking[int(source)].append(dest)
+                cursor.execute('SELECT source, dest FROM mastertickets WHERE dest IN (%s)'
+                               % placeholders(len(chunk)), chunk)
+                for source, dest in cursor:
+                    blocked_by[int(dest)].append(source)
+        return dict((i, cls(env, i, ticket_cache=ticket_cache,
+                            links=(blocking[i], blocked_by[i])))
+                    for i in ids)
+
+    @classmethod
+    def load_project(cls, env, pid, ticket_cache=None, db=None, linked_only=False):
+        """Load links of all tickets of project `pid`.
+
+        Links having an end in the project are fetched with one join,
+        project tickets with one projection query, both iterated without
+        buffering all rows. Tickets of other projects linked to the project
+        are included. With `linked_only`, tickets without links are skipped.
+        Tickets are stored in `ticket_cache` as `TicketSummary` objects.
+        Return a dict `{tkt_id: TicketLinks}`.
+        """
+        db = db or env.get_read_db()
+        cursor = db.cursor()
+        blocking = {}
+        blocked_by = {}
+        cursor.execute("""
+            SELECT m.source, m.dest FROM mastertickets m
+            JOIN ticket s ON s.id=m.source
+            JOIN ticket d ON d.id=m.dest
+            WHERE s.project_id=%s OR d.project_id=%s
+            """, (pid, pid))
+        for source, dest in cursor:
+            source, dest = int(source), int(dest)
+            blocking.setdefault(source, []).append(dest)
+            blocked_by.setdefault(dest, []).append(source)
+
+        if ticket_cache is None:
+            ticket_cache = {}
+        ids = set()
+        cursor.execute("""
+            SELECT id, project_id, summary, status, resolution, milestone
+            FROM ticket WHERE project_id=%s
+            """, (pid,))
+        for row in cursor:
+            tkt_id = int(row[0])
+            if linked_only and tkt_id not in blocking and tkt_id not in blocked_by:
+                continue
+            ids.add(tkt_id)
+            ticket_cache[tkt_id] = TicketSummary(tkt_id, *row[1:])
+        foreign = set(chain(blocking, blocked_by)) - ids
+        if foreign:
+            ticket_cache.update(TicketSummary.load_many(env, foreign, db))
+            ids.update(foreign)
+        return dict((i, cls(env, i, ticket_cache=ticket_cache,
+                            links=(blocking.get(i, ()), blocked_by.get(i, ()))))
+                    for i in ids)
+
     def save(self, author, comment='', when=None, db=None):
         """Save new links."""
-        if when is None:
-            when = datetime.now(utc)
-        when_ts = to_utimestamp(when)
-
         handle_commit = False
         if db is None:
             db = self.env.get_db_cnx()
             handle_commit = True
-        cursor = db.cursor()
 
-        new_blocking = set(int(n) for n in self.blocking if int(n) != self.tkt.id)
-        new_blocked_by = set(int(n) for n in self.blocked_by if int(n) != self.tkt.id)
-
-        to_check = [
-            # new, old, field
-            (new_blocking, self._old_blocking, 'blockedby', ('source', 'dest')),
-            (new_blocked_by, self._old_blocked_by, 'blocking', ('dest', 'source')),
-        ]
-
-        commented_tickets = set()
-
-        for new_ids, old_ids, field, sourcedest in to_check:
-            for n in new_ids | old_ids:
-                update_field = None
-                if n in new_ids and n not in old_ids:
-                    # New ticket added
-                    cursor.execute('INSERT INTO mastertickets (%s, %s) VALUES (%%s, %%s)'%sourcedest, (self.tkt.id, n))
-                    update_field = lambda tset: tset.add(str(self.tkt.id))
-                elif n not in new_ids and n in old_ids:
-                    # Old ticket removed
-                    cursor.execute('DELETE FROM mastertickets WHERE %s=%%s AND %s=%%s'%sourcedest, (self.tkt.id, n))
-                    update_field = lambda tset: tset.remove(str(self.tkt.id))
-
-                if update_field is not None:
-                    cursor.execute('SELECT value FROM ticket_custom WHERE ticket=%s AND name=%s',
-                                   (n, str(field)))
-                    res = cursor.fetchone()
-                    old_value = res[0] if res and res[0] else ''
-                    new_value = set([x.strip() for x in old_value.split(',') if x.strip()])
-                    inconsistent = False
-                    try:
-                        update_field(new_value)
-                    except KeyError, e:
-                        inconsistent = True
-                        self.env.log.warn('Inconsistent mastertickets data for ticket #%s. %s',
-                                           self.tkt.id, exception_to_unicode(e))
-                    new_value = ', '.join(sorted(new_value, key=lambda x: int(x)))
-
-                    changed = old_value != new_value
-                    if changed:
-                        cursor.execute('INSERT INTO ticket_change (ticket, time, author, field, oldvalue, newvalue) VALUES (%s, %s, %s, %s, %s, %s)',
-                                       (n, when_ts, author, field, old_value, new_value))
-
-                        if comment and n not in commented_tickets:
-                            cursor.execute('INSERT INTO ticket_change (ticket, time, author, field, oldvalue, newvalue) VALUES (%s, %s, %s, %s, %s, %s)',
-                                           (n, when_ts, author, 'comment', '', '(In #%s) %s'%(self.tkt.id, comment)))
-                            commented_tickets.add(n)
-
-                    if not changed and not inconsistent:
-                        continue
-
-                    cursor.execute('UPDATE ticket_custom SET value=%s WHERE ticket=%s AND name=%s',
-                                   (new_value, n, field))
-                    updated = cursor.rowcount == 1
-
-                    # refresh the changetime to prevent concurrent edits
-                    cursor.execute('UPDATE ticket SET changetime=%s WHERE id=%s', (when_ts,n))
-
-                    if not updated:
-                        cursor.execute('INSERT INTO ticket_custom (ticket, name, value) VALUES (%s, %s, %s)',
-                                       (n, field, new_value))
+        new_blocking = set(int(n) for n in self.blocking if int(n) != self.tkt_id)
+        new_blocked_by = set(int(n) for n in self.blocked_by if int(n) != self.tkt_id)
+
+        added = set()
+        removed = set()
+        for n in new_blocking - self._old_blocking:
+            added.add((self.tkt_id, n))
+        for n in self._old_blocking - new_blocking:
+            removed.add((self.tkt_id, n))
+        for n in new_blocked_by - self._old_blocked_by:
+            added.add((n, self.tkt_id))
+        for n in self._old_blocked_by - new_blocked_by:
+            removed.add((n, self.tkt_id))
+
+        if comment:
+            comment = '(In #%s) %s' % (self.tkt_id, comment)
+        update_links(self.env, added, removed, author, comment, when, db,
+                     origin=self.tkt_id)
 
         if handle_commit:
             db.commit()
@@ -129,25 +197,717 @@ class TicketLinks(object):
             return '[%s]'%','.join(arr2)
 
         return '<mastertickets.model.TicketLinks #%s blocking=%s blocked_by=%s>'% \
-               (self.tkt.id, l(getattr(self, 'blocking', [])), l(getattr(self, 'blocked_by', [])))
+               (self.tkt_id, l(getattr(self, 'blocking', [])), l(getattr(self, 'blocked_by', [])))
 
     @staticmethod
-    def walk_tickets(env, tkt_ids, ticket_cache=None):
-        """Return an iterable of all links reachable directly above or below those ones."""
-        def visit(tkt, memo, next_fn):
-            if tkt in memo:
-                return False
-
-            links = TicketLinks(env, tkt, ticket_cache)
-            memo[tkt] = links
-
-            for n in next_fn(links):
-                visit(n, memo, next_fn)
-
-        memo1 = {}
-        memo2 = {}
-        for id in tkt_ids:
-            visit(id, memo1, lambda links: links.blocking)
-            visit(id, memo2, lambda links: links.blocked_by)
-        memo1.update(memo2)
-        return memo1.itervalues()
+    def walk_tickets(env, tkt_ids, ticket_cache=None, db=None,
+                     max_depth=None, max_nodes=None, direction='both'):
+        """Return an iterable of all links reachable directly above or below those ones.
+
+        Reachable tickets are found with `descendants` (`direction` 'down')
+        and `ancestors` ('up') and their links are then loaded in one batch
+        (see `load_many`). Tickets are stored in `ticket_cache` as
+        `TicketSummary` objects. The walk goes no further than `max_depth`
+        levels from `tkt_ids` and collects at most `max_nodes` tickets,
+        nearest first (unlimited if `None`).
+        """
+        db = db or env.get_db_cnx()
+        depths = dict((int(i), 0) for i in tkt_ids)
+        start = list(depths)
+        walks = []
+        if direction in ('both', 'down'):
+            walks.append(descendants)
+        if direction in ('both', 'up'):
+            walks.append(ancestors)
+        for walk in walks:
+            for i, depth in walk(env, start, db, max_depth).iteritems():
+                if depth < depths.get(i, depth + 1):
+                    depths[i] = depth
+        ids = sorted(depths, key=lambda i: (depths[i], i))
+        if max_nodes is not None:
+            ids = ids[:max_nodes]
+        if ticket_cache is None:
+            ticket_cache = {}
+        ticket_cache.update(TicketSummary.load_many(
+            env, [i for i in ids if i not in ticket_cache], db))
+        return TicketLinks.load_many(env, ids, db, ticket_cache).itervalues()
+
+
+class TicketSummary(object):
+    """Lightweight, read-only projection of the ticket attributes used by
+    dependency graphs."""
+
+    __slots__ = ('id', 'pid', 'summary', 'status', 'resolution', 'milestone')
+
+    fields = ('summary', 'status', 'resolution', 'milestone')
+
+    def __init__(self, id, pid, summary, status, resolution, milestone):
+        self.id = id
+        self.pid = pid
+        self.summary = summary
+        self.status = status
+        self.resolution = resolution
+        self.milestone = milestone
+
+    def __getitem__(self, name):
+        """Allow `tkt['summary']` access like for `Ticket` objects."""
+        if name not in self.fields:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __repr__(self):
+        return '<mastertickets.model.TicketSummary #%s>' % self.id
+
+    @classmethod
+    def load_many(cls, env, tkt_ids, db=None):
+        """Load tickets with one projection query per chunk of IDs.
+
+        Return a dict `{tkt_id: TicketSummary}`, unknown IDs are skipped.
+        """
+        ids = sorted(set(int(i) for i in tkt_ids))
+        result = {}
+        if not ids:
+            return result
+        db = db or env.get_read_db()
+        cursor = db.cursor()
+        for chunk in chunked(ids):
+            cursor.execute("""
+                SELECT id, project_id, summary, status, resolution, milestone
+                FROM ticket WHERE id IN (%s)
+                """ % placeholders(len(chunk)), chunk)
+            for row in cursor:
+                result[int(row[0])] = cls(int(row[0]), *row[1:])
+        return result
+
+
+class LinkGraph(object):
+    """Compact, read-only adjacency structure of ticket links.
+
+    Ticket IDs are kept in a sorted `array('i')`, links of both directions
+    are stored CSR-style as offset and target arrays of indexes into it.
+    This takes a fraction of the memory of per-ticket sets.
+    """
+
+    def __init__(self, pairs=()):
+        heads = array('i')
+        tails = array('i')
+        for source, dest in pairs:
+            heads.append(int(source))
+            tails.append(int(dest))
+        self.ids = array('i', sorted(set(heads) | set(tails)))
+        index = dict((tkt_id, i) for i, tkt_id in enumerate(self.ids))
+        heads = array('i', [index[tkt_id] for tkt_id in heads])
+        tails = array('i', [index[tkt_id] for tkt_id in tails])
+        index.clear()
+        self._out_offsets, self._out_targets = self._csr(len(self.ids), heads, tails)
+        self._in_offsets, self._in_targets = self._csr(len(self.ids), tails, heads)
+
+    @staticmethod
+    def _csr(n, heads, tails):
+        offsets = array('i', [0]) * (n + 1)
+        for head in heads:
+            offsets[head + 1] += 1
+        for i in xrange(n):
+            offsets[i + 1] += offsets[i]
+        targets = array('i', [0]) * len(heads)
+        pos = offsets[:-1]
+        for head, tail in izip(heads, tails):
+            targets[pos[head]] = tail
+            pos[head] += 1
+        for i in xrange(n):
+            start, end = offsets[i], offsets[i + 1]
+            if end - start > 1:
+                targets[start:end] = array('i', sorted(targets[start:end]))
+        return offsets, targets
+
+    @classmethod
+    def load(cls, env, pid=None, db=None):
+        """Load links having an end in project `pid` (all links if `None`),
+        like `TicketLinks.load_project`."""
+        db = db or env.get_read_db()
+        cursor = db.cursor()
+        if pid is None:
+            cursor.execute('SELECT source, dest FROM mastertickets')
+        else:
+            cursor.execute("""
+                SELECT m.source, m.dest FROM mastertickets m
+                JOIN ticket s ON s.id=m.source
+                JOIN ticket d ON d.id=m.dest
+                WHERE s.project_id=%s OR d.project_id=%s
+                """, (pid, pid))
+        return cls(cursor)
+
+    def _index(self, tkt_id):
+        i = bisect_left(self.ids, tkt_id)
+        if i < len(self.ids) and self.ids[i] == tkt_id:
+            return i
+        return -1
+
+    def _adjacent(self, tkt_id, offsets, targets):
+        i = self._index(tkt_id)
+        if i < 0:
+            return []
+        ids = self.ids
+        return [ids[j] for j in targets[offsets[i]:offsets[i + 1]]]
+
+    def blocking(self, tkt_id):
+        """Return IDs of tickets blocked by `tkt_id`."""
+        return self._adjacent(tkt_id, self._out_offsets, self._out_targets)
+
+    def blocked_by(self, tkt_id):
+        """Return IDs of tickets blocking `tkt_id`."""
+        return self._adjacent(tkt_id, self._in_offsets, self._in_targets)
+
+    def get(self, tkt_id):
+        """Return `(blocking, blocked_by)` of ticket `tkt_id`."""
+        return (self.blocking(tkt_id), self.blocked_by(tkt_id))
+
+    def edges(self):
+        """Iterate over all `(source, dest)` links."""
+        ids = self.ids
+        offsets = self._out_offsets
+        targets = self._out_targets
+        for i in xrange(len(ids)):
+            for j in xrange(offsets[i], offsets[i + 1]):
+                yield ids[i], ids[targets[j]]
+
+    def reachable(self, tkt_id, forward=True, max_depth=None):
+        """Return `{tkt_id: depth}` of tickets transitively blocked by
+        `tkt_id` (blocking it if `forward` is `False`)."""
+        if forward:
+            offsets, targets = self._out_offsets, self._out_targets
+        else:
+            offsets, targets = self._in_offsets, self._in_targets
+        if max_depth is None:
+            max_depth = MAX_WALK_DEPTH
+        i = self._index(tkt_id)
+        if i < 0:
+            return {}
+        depths = {}
+        frontier = [i]
+        depth = 0
+        while frontier and depth < max_depth:
+            depth += 1
+            next_idx = []
+            for i in frontier:
+                for j in targets[offsets[i]:offsets[i + 1]]:
+                    if j not in depths:
+                        depths[j] = depth
+                        next_idx.append(j)
+            frontier = next_idx
+        ids = self.ids
+        return dict((ids[j], depth) for j, depth in depths.iteritems())
+
+    def _scc_labels(self):
+        """Label every node with the number of its strongly connected
+        component (iterative Tarjan's algorithm)."""
+        offsets = self._out_offsets
+        targets = self._out_targets
+        n = len(self.ids)
+        order = array('i', [-1]) * n
+        low = array('i', [0]) * n
+        labels = array('i', [-1]) * n
+        on_stack = array('b', [0]) * n
+        stack = []
+        counter = 0
+        component = 0
+        for root in xrange(n):
+            if order[root] >= 0:
+                continue
+            order[root] = low[root] = counter
+            counter += 1
+            stack.append(root)
+            on_stack[root] = 1
+            work = [(root, offsets[root])]
+            while work:
+                i, pos = work[-1]
+                if pos < offsets[i + 1]:
+                    work[-1] = (i, pos + 1)
+                    j = targets[pos]
+                    if order[j] < 0:
+                        order[j] = low[j] = counter
+                        counter += 1
+                        stack.append(j)
+                        on_stack[j] = 1
+                        work.append((j, offsets[j]))
+                    elif on_stack[j] and order[j] < low[i]:
+                        low[i] = order[j]
+                    continue
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    if low[i] < low[parent]:
+                        low[parent] = low[i]
+                if low[i] == order[i]:
+                    while True:
+                        j = stack.pop()
+                        on_stack[j] = 0
+                        labels[j] = component
+                        if j == i:
+                            break
+                    component += 1
+        return labels
+
+    def cyclic_links(self, pairs):
+        """Return those of the `(source, dest)` links `pairs` of this graph
+        which lie on a cycle, found with a single pass over the graph."""
+        labels = self._scc_labels()
+        result = []
+        for source, dest in pairs:
+            i, j = self._index(source), self._index(dest)
+            if i >= 0 and j >= 0 and (i == j or labels[i] == labels[j]):
+                result.append((source, dest))
+        return result
+
+    def path(self, source, dest):
+        """Return the IDs along the shortest path from `source` to `dest`,
+        or `None` if there is no such path."""
+        offsets = self._out_offsets
+        targets = self._out_targets
+        i, goal = self._index(source), self._index(dest)
+        if i < 0 or goal < 0:
+            return None
+        parents = {i: None}
+        frontier = [i]
+        while frontier and goal not in parents:
+            next_idx = []
+            for i in frontier:
+                for j in targets[offsets[i]:offsets[i + 1]]:
+                    if j not in parents:
+                        parents[j] = i
+                        next_idx.append(j)
+            frontier = next_idx
+        if goal not in parents:
+            return None
+        path = []
+        i = goal
+        while i is not None:
+            path.append(self.ids[i])
+            i = parents[i]
+        path.reverse()
+        return path
+
+    def __contains__(self, tkt_id):
+        return self._index(tkt_id) >= 0
+
+    @property
+    def num_links(self):
+        """Number of links in the graph."""
+        return len(self._out_targets)
+
+
+def update_links(env, added, removed, author, comment='', when=None, db=None,
+                 origin=None):
+    """Add and remove links and update `blocking`/`blockedby` fields.
+
+    `added` and `removed` are collections of `(source, dest)` pairs. All
+    affected `ticket_custom` rows are fetched at once, changed values are
+    computed in memory and written back with a few `executemany` batches.
+    Every ticket whose field changed gets a `ticket_change` record and,
+    if given, `comment`. Fields of the `origin` ticket are left alone, it
+    is expected to be saved by the caller.
+    """
+    added = sorted(set((int(s), int(d)) for s, d in added))
+    removed = sorted(set((int(s), int(d)) for s, d in removed))
+    if not added and not removed:
+        return
+    if when is None:
+        when = datetime.now(utc)
+    when_ts = to_utimestamp(when)
+    db = db or env.get_db_cnx()
+    cursor = db.cursor()
+
+    if added:
+        cursor.executemany('INSERT INTO mastertickets (source, dest) VALUES (%s, %s)', added)
+    if removed:
+        cursor.executemany('DELETE FROM mastertickets WHERE source=%s AND dest=%s', removed)
+
+    # {(ticket, field): (ids to add, ids to remove)}
+    deltas = {}
+    for pairs, idx in ((added, 0), (removed, 1)):
+        for source, dest in pairs:
+            for tkt_id, field, value in ((source, 'blocking', dest),
+                                         (dest, 'blockedby', source)):
+                if tkt_id != origin:
+                    deltas.setdefault((tkt_id, field), (set(), set()))[idx].add(str(value))
+
+    tkt_ids = sorted(set(tkt_id for tkt_id, field in deltas))
+    old_values = {}
+    for chunk in chunked(tkt_ids):
+        cursor.execute("""
+            SELECT ticket, name, value FROM ticket_custom
+            WHERE name IN ('blocking', 'blockedby') AND ticket IN (%s)
+            """ % placeholders(len(chunk)), chunk)
+        for tkt_id, field, value in cursor:
+            old_values[(int(tkt_id), field)] = value or ''
+
+    changes = []
+    to_update = []
+    to_insert = []
+    touched = set()
+    commented_tickets = set()
+    for key in sorted(deltas):
+        tkt_id, field = key
+        to_add, to_remove = deltas[key]
+        old_value = old_values.get(key, '')
+        new_value = set([x.strip() for x in old_value.split(',') if x.strip()])
+        inconsistent = not to_remove <= new_value
+        if inconsistent:
+            env.log.warn('Inconsistent mastertickets data for ticket #%s: %s does not contain %s',
+                         tkt_id, field, ', '.join(sorted(to_remove - new_value)))
+        new_value = (new_value - to_remove) | to_add
+        new_value = ', '.join(sorted(new_value, key=lambda x: int(x)))
+
+        changed = old_value != new_value
+        if changed:
+            changes.append((tkt_id, when_ts, author, field, old_value, new_value))
+            if comment and tkt_id not in commented_tickets:
+                changes.append((tkt_id, when_ts, author, 'comment', '', comment))
+                commented_tickets.add(tkt_id)
+
+        if not changed and not inconsistent:
+            continue
+
+        if key in old_values:
+            to_update.append((new_value, tkt_id, field))
+        else:
+            to_insert.append((tkt_id, field, new_value))
+        touched.add(tkt_id)
+
+    if changes:
+        cursor.executemany('INSERT INTO ticket_change (ticket, time, author, field, oldvalue, newvalue) VALUES (%s, %s, %s, %s, %s, %s)',
+                           changes)
+    if to_update:
+        cursor.executemany('UPDATE ticket_custom SET value=%s WHERE ticket=%s AND name=%s',
+                           to_update)
+    if to_insert:
+        cursor.executemany('INSERT INTO ticket_custom (ticket, name, value) VALUES (%s, %s, %s)',
+                           to_insert)
+    if touched:
+        # refresh the changetime to prevent concurrent edits
+        cursor.executemany('UPDATE ticket SET changetime=%s WHERE id=%s',
+                           [(when_ts, tkt_id) for tkt_id in sorted(touched)])
+
+    update_closure(env, set(source for source, dest in added + removed), db)
+    bump_links_generation(db)
+
+
+def get_links_generation(db):
+    """Return the current generation of the link table.
+
+    The value changes whenever links are added or removed, so it can be
+    compared to detect stale copies of link data.
+    """
+    cursor = db.cursor()
+    cursor.execute('SELECT value FROM system WHERE name=%s', (GENERATION_KEY,))
+    row = cursor.fetchone()
+    return row[0] if row else ''
+
+def get_project_changetime(db, pid):
+    """Return the latest `changetime` of the tickets of project `pid` and
+    of the tickets linked to them (0 if there are none)."""
+    cursor = db.cursor()
+    cursor.execute("""
+        SELECT MAX(t.changetime) FROM ticket t
+        WHERE t.project_id=%s
+           OR t.id IN (SELECT m.dest FROM mastertickets m
+                       JOIN ticket s ON s.id=m.source WHERE s.project_id=%s)
+           OR t.id IN (SELECT m.source FROM mastertickets m
+                       JOIN ticket d ON d.id=m.dest WHERE d.project_id=%s)
+        """, (pid, pid, pid))
+    row = cursor.fetchone()
+    return row and row[0] or 0
+
+def bump_links_generation(db):
+    """Mark link data as changed, see `get_links_generation`."""
+    cursor = db.cursor()
+    generation = hex_entropy(16)
+    cursor.execute('UPDATE system SET value=%s WHERE name=%s', (generation, GENERATION_KEY))
+    if cursor.rowcount != 1:
+        cursor.execute('INSERT INTO system (name, value) VALUES (%s, %s)', (GENERATION_KEY, generation))
+    return generation
+
+
+def descendants(env, tkt_ids, db=None, max_depth=None):
+    """Return tickets transitively blocked by `tkt_ids`.
+
+    Links are followed from source to dest, i.e. along `blocking`.
+    Return a dict `{tkt_id: depth}` where depth is the length of the
+    shortest path from any of `tkt_ids`.
+    """
+    return _closure_lookup(env, tkt_ids, db, max_depth, ('ancestor', 'descendant'))
+
+def ancestors(env, tkt_ids, db=None, max_depth=None):
+    """Return tickets transitively blocking `tkt_ids`.
+
+    Links are followed from dest to source, i.e. along `blocked_by`.
+    Return a dict `{tkt_id: depth}` like `descendants`.
+    """
+    return _closure_lookup(env, tkt_ids, db, max_depth, ('descendant', 'ancestor'))
+
+def is_reachable(env, sources, targets, db=None):
+    """Check whether any of `targets` is transitively blocked by any of `sources`."""
+    sources = sorted(set(int(i) for i in sources))
+    targets = sorted(set(int(i) for i in targets))
+    if not sources or not targets:
+        return False
+    db = db or env.get_read_db()
+    cursor = db.cursor()
+    for source_chunk in chunked(sources):
+        for target_chunk in chunked(targets):
+            cursor.execute("""
+                SELECT ancestor FROM mastertickets_closure
+                WHERE ancestor IN (%s) AND descendant IN (%s)
+                """ % (placeholders(len(source_chunk)), placeholders(len(target_chunk))),
+                source_chunk + target_chunk)
+            if cursor.fetchone() is not None:
+                return True
+    return False
+
+def has_links(env, tkt_id, db=None):
+    """Check whether ticket `tkt_id` blocks or is blocked by any ticket."""
+    db = db or env.get_read_db()
+    cursor = db.cursor()
+    cursor.execute('SELECT source FROM mastertickets WHERE source=%s OR dest=%s LIMIT 1',
+                   (tkt_id, tkt_id))
+    return cursor.fetchone() is not None
+
+def unclosed_tickets(env, tkt_ids, transitive=False, db=None):
+    """Return IDs of tickets from `tkt_ids` which are not closed.
+
+    With `transitive`, tickets transitively blocking any of `tkt_ids`
+    are checked as well. Statuses are read with one query per chunk.
+    """
+    ids = sorted(set(int(i) for i in tkt_ids))
+    result = set()
+    if not ids:
+        return result
+    db = db or env.get_read_db()
+    cursor = db.cursor()
+    for chunk in chunked(ids):
+        if transitive:
+            cursor.execute("""
+                SELECT id FROM ticket
+                WHERE status!='closed' AND (id IN (%s) OR id IN (
+                    SELECT ancestor FROM mastertickets_closure
+                    WHERE descendant IN (%s)))
+                """ % (placeholders(len(chunk)), placeholders(len(chunk))),
+                chunk + chunk)
+        else:
+            cursor.execute("SELECT id FROM ticket WHERE status!='closed' AND id IN (%s)"
+                           % placeholders(len(chunk)), chunk)
+        result.update(int(row[0]) for row in cursor)
+    return result
+
+def find_path(env, sources, targets, db=None):
+    """Return the shortest link path from any of `sources` to any of `targets`.
+
+    The search runs breadth-first from both ends at once, along `blocking`
+    from `sources` and along `blocked_by` from `targets`, always extending
+    the smaller frontier with one batched query. Every ticket is expanded
+    at most once, so existing cycles elsewhere in the graph are harmless.
+    Return the list of ticket IDs along the path or `None`.
+    """
+    sources = set(int(i) for i in sources)
+    targets = set(int(i) for i in targets)
+    common = sources & targets
+    if common:
+        return [min(common)]
+    db = db or env.get_read_db()
+    cursor = db.cursor()
+
+    # {tkt_id: previous ticket towards sources / next ticket towards targets}
+    forward = dict((i, None) for i in sources)
+    backward = dict((i, None) for i in targets)
+
+    def build_path(meeting):
+        path = []
+        n = meeting
+        while n is not None:
+            path.append(n)
+            n = forward[n]
+        path.reverse()
+        n = backward[meeting]
+        while n is not None:
+            path.append(n)
+            n = backward[n]
+        return path
+
+    frontiers = {True: sorted(sources), False: sorted(targets)}
+    while frontiers[True] and frontiers[False]:
+        is_forward = len(frontiers[True]) <= len(frontiers[False])
+        if is_forward:
+            visited, other, fromto = forward, backward, ('source', 'dest')
+        else:
+            visited, other, fromto = backward, forward, ('dest', 'source')
+        next_ids = []
+        for chunk in chunked(frontiers[is_forward]):
+            cursor.execute('SELECT %s, %s FROM mastertickets WHERE %s IN (%s) ORDER BY %s, %s'
+                           % (fromto[0], fromto[1], fromto[0], placeholders(len(chunk)),
+                              fromto[0], fromto[1]), chunk)
+            for n, m in cursor.fetchall():
+                n, m = int(n), int(m)
+                if m in visited:
+                    continue
+                visited[m] = n
+                if m in other:
+                    return build_path(m)
+                next_ids.append(m)
+        frontiers[is_forward] = next_ids
+    return None
+
+def _closure_lookup(env, tkt_ids, db, max_depth, fromto):
+    ids = sorted(set(int(i) for i in tkt_ids))
+    if not ids:
+        return {}
+    db = db or env.get_read_db()
+    cursor = db.cursor()
+    depth_sql = ''
+    depth_args = []
+    if max_depth is not None:
+        depth_sql = 'AND depth<=%s'
+        depth_args = [max_depth]
+    result = {}
+    for chunk in chunked(ids):
+        cursor.execute("""
+            SELECT %s, MIN(depth) FROM mastertickets_closure
+            WHERE %s IN (%s) %s
+            GROUP BY %s
+            """ % (fromto[1], fromto[0], placeholders(len(chunk)), depth_sql, fromto[1]),
+            chunk + depth_args)
+        for num, depth in cursor:
+            num = int(num)
+            if depth < result.get(num, depth + 1):
+                result[num] = depth
+    return result
+
+def update_closure(env, tkt_ids, db=None):
+    """Bring `mastertickets_closure` up to date after links of `tkt_ids` changed.
+
+    `tkt_ids` are the sources of all added or removed links. Only rows
+    of these tickets and of their ancestors are recomputed, other rows
+    are not affected by the change.
+    """
+    db = db or env.get_db_cnx()
+    cursor = db.cursor()
+
+    affected = set(int(i) for i in tkt_ids)
+    affected.update(ancestors(env, affected, db))
+    affected = sorted(affected)
+
+    # Load the part of the link graph reachable from affected tickets
+    region = set(affected)
+    region.update(_walk_links(env, affected, db, None, ('source', 'dest')))
+    pairs = []
+    for chunk in chunked(sorted(region)):
+        cursor.execute('SELECT source, dest FROM mastertickets WHERE source IN (%s)'
+                       % placeholders(len(chunk)), chunk)
+        pairs.extend(cursor)
+    graph = LinkGraph(pairs)
+    del pairs
+
+    rows = {} # {(ancestor, descendant): depth}
+    for tkt_id in affected:
+        for num, depth in graph.reachable(tkt_id).iteritems():
+            rows[(tkt_id, num)] = depth
+
+    to_delete = []
+    to_update = []
+    for chunk in chunked(affected):
+        cursor.execute('SELECT ancestor, descendant, depth FROM mastertickets_closure '
+                       'WHERE ancestor IN (%s)' % placeholders(len(chunk)), chunk)
+        for ancestor, descendant, depth in cursor:
+            key = (int(ancestor), int(descendant))
+            new_depth = rows.pop(key, None)
+            if new_depth is None:
+                to_delete.append(key)
+            elif new_depth != depth:
+                to_update.append((new_depth,) + key)
+    to_insert = [key + (depth,) for key, depth in rows.iteritems()]
+
+    if to_delete:
+        cursor.executemany('DELETE FROM mastertickets_closure WHERE ancestor=%s AND descendant=%s',
+                           to_delete)
+    if to_update:
+        cursor.executemany('UPDATE mastertickets_closure SET depth=%s WHERE ancestor=%s AND descendant=%s',
+                           to_update)
+    if to_insert:
+        cursor.executemany('INSERT INTO mastertickets_closure (ancestor, descendant, depth) VALUES (%s, %s, %s)',
+                           to_insert)
+
+def rebuild_closure(env, db=None):
+    """Recompute the whole `mastertickets_closure` table from scratch."""
+    db = db or env.get_db_cnx()
+    cursor = db.cursor()
+    graph = LinkGraph.load(env, db=db)
+
+    cursor.execute('DELETE FROM mastertickets_closure')
+    for chunk in chunked(graph.ids):
+        rows = []
+        for tkt_id in chunk:
+            rows.extend((tkt_id, num, depth)
+                        for num, depth in graph.reachable(tkt_id).iteritems())
+        if rows:
+            cursor.executemany('INSERT INTO mastertickets_closure (ancestor, descendant, depth) VALUES (%s, %s, %s)',
+                               rows)
+
+def _walk_links(env, tkt_ids, db, max_depth, fromto):
+    db = db or env.get_db_cnx()
+    ids = sorted(set(int(i) for i in tkt_ids))
+    if max_depth is None:
+        max_depth = MAX_WALK_DEPTH
+    if not ids or max_depth < 1:
+        return {}
+    if _has_recursive_cte(env):
+        return _walk_links_cte(db, ids, max_depth, fromto)
+
+    # Fallback: breadth-first walk, one query per frontier chunk
+    cursor = db.cursor()
+    result = {}
+    frontier = ids
+    depth = 1
+    while frontier and depth <= max_depth:
+        next_ids = set()
+        for chunk in chunked(frontier):
+            cursor.execute('SELECT %s FROM mastertickets WHERE %s IN (%s)'
+                           % (fromto[1], fromto[0], placeholders(len(chunk))), chunk)
+            next_ids.update(int(num) for num, in cursor)
+        frontier = sorted(next_ids - set(result))
+        for i in frontier:
+            result[i] = depth
+        depth += 1
+    return result
+
+def _walk_links_cte(db, ids, max_depth, fromto):
+    cursor = db.cursor()
+    result = {}
+    for chunk in chunked(ids):
+        cursor.execute("""
+            WITH RECURSIVE reachable(id, depth) AS (
+                SELECT %(to)s, 1 FROM mastertickets WHERE %(from)s IN (%(ids)s)
+                UNION
+                SELECT m.%(to)s, r.depth + 1
+                FROM mastertickets m, reachable r
+                WHERE m.%(from)s = r.id AND r.depth < %%s
+            )
+            SELECT id, MIN(depth) FROM reachable GROUP BY id
+            """ % {'from': fromto[0], 'to': fromto[1], 'ids': placeholders(len(chunk))},
+            chunk + [max_depth])
+        for num, depth in cursor:
+            num = int(num)
+            if depth < result.get(num, depth + 1):
+                result[num] = depth
+    return result
+
+def _has_recursive_cte(env):
+    """Check whether the database backend supports ``WITH RECURSIVE``."""
+    scheme = env.config.get('trac', 'database').split(':', 1)[0]
+    if scheme == 'postgres':
+        return True
+    if scheme == 'sqlite':
+        try:
+            from trac.db.sqlite_backend import sqlite_version
+        except ImportError:
+            return False
+        return sqlite_version >= (3, 8, 3)
+    return False
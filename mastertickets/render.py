@@ -0,0 +1,296 @@
+# Copyright (c) 2012 Aleksey A. Porfirov
+
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+from trac.core import *
+from trac.config import IntOption, Option
+from trac.web.api import HTTPServiceUnavailable
+
+from api import _
+
+
+class DepgraphRenderCache(Component):
+    """On-disk cache of rendered dependency graphs.
+
+    Entries are addressed by a hash of the DOT source, the output format
+    and the tools used to render it, so identical graphs are rendered
+    only once, whichever process asks for them.
+    """
+
+    cache_dir = Option('mastertickets', 'render_cache_dir', default='cache/mastertickets',
+        doc='Directory of the rendered graph cache, relative to the environment directory.')
+    cache_max_size = IntOption('mastertickets', 'render_cache_max_size', default=10240,
+        doc='Maximum size of the rendered graph cache in kilobytes (0 to disable the cache).')
+    cache_max_age = IntOption('mastertickets', 'render_cache_max_age', default=7 * 24 * 3600,
+        doc='Seconds after which unused rendered graphs are removed from the cache.')
+
+    SUFFIX = '.out'
+
+    @property
+    def enabled(self):
+        return self.cache_max_size > 0
+
+    @property
+    def path(self):
+        return os.path.join(self.env.path, self.cache_dir)
+
+    def get_key(self, source, format, *tools):
+        """Return the cache key of DOT `source` rendered to `format`
+        with `tools`.
+        """
+        sha = hashlib.sha1()
+        for part in (format,) + tools:
+            sha.update(part.encode('utf8') if isinstance(part, unicode) else part)
+            sha.update('\0')
+        sha.update(source.encode('utf8') if isinstance(source, unicode) else source)
+        return sha.hexdigest()
+
+    def open(self, key):
+        """Return an open file of cached data for `key` or `None`."""
+        if not self.enabled:
+            return None
+        filename = self._filename(key)
+        try:
+            mtime = os.stat(filename).st_mtime
+            if self.cache_max_age > 0 and mtime < time.time() - self.cache_max_age:
+                return None
+            f = open(filename, 'rb')
+            # keep recently used entries from eviction
+            os.utime(filename, None)
+        except (IOError, OSError):
+            return None
+        return f
+
+    def get(self, key):
+        """Return cached data for `key` or `None`."""
+        f = self.open(key)
+        if f is None:
+            return None
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def put(self, key, data):
+        """Store `data` for `key`."""
+        writer = self.writer(key)
+        if writer is not None:
+            writer.write(data)
+            writer.commit()
+
+    def writer(self, key):
+        """Return a `CacheWriter` storing data for `key` incrementally,
+        or `None` if the cache is disabled.
+
+        The data is written to a temporary file which is renamed on
+        commit, so readers never see partial entries.
+        """
+        if not self.enabled:
+            return None
+        path = self.path
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                self.log.warning('MasterTickets: Can not create render cache dir %s: %s',
+                                 path, e)
+                return None
+        try:
+            fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=path)
+        except (IOError, OSError), e:
+            self.log.warning('MasterTickets: Can not write render cache: %s', e)
+            return None
+        return CacheWriter(self, key, os.fdopen(fd, 'wb'), tmp)
+
+    def evict(self):
+        """Remove expired entries, then the least recently used ones
+        until the cache fits in its maximum size.
+        """
+        path = self.path
+        try:
+            names = os.listdir(path)
+        except OSError:
+            return
+        expire = time.time() - self.cache_max_age if self.cache_max_age > 0 else None
+        entries = []
+        total = 0
+        for name in names:
+            if not name.endswith(self.SUFFIX):
+                continue
+            filename = os.path.join(path, name)
+            try:
+                st = os.stat(filename)
+                if expire is not None and st.st_mtime < expire:
+                    os.unlink(filename)
+                    continue
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, filename))
+            total += st.st_size
+        max_size = self.cache_max_size * 1024
+        if total <= max_size:
+            return
+        entries.sort()
+        for mtime, size, filename in entries:
+            try:
+                os.unlink(filename)
+            except OSError:
+                pass
+            total -= size
+            if total <= max_size:
+                break
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + self.SUFFIX)
+
+
+class CacheWriter(object):
+    """Incremental writer of a render cache entry.
+
+    Entries outgrowing the maximum cache size are dropped.
+    """
+
+    def __init__(self, cache, key, f, tmp):
+        self.cache = cache
+        self.key = key
+        self.size = 0
+        self._f = f
+        self._tmp = tmp
+
+    def write(self, data):
+        if self._f is None:
+            return
+        self.size += len(data)
+        if self.size > self.cache.cache_max_size * 1024:
+            self.abort()
+            return
+        try:
+            self._f.write(data)
+        except (IOError, OSError), e:
+            self.cache.log.debug('MasterTickets: Can not write render cache entry %s: %s',
+                                 self.key, e)
+            self.abort()
+
+    def commit(self):
+        """Make the written data available, unless it is empty."""
+        if self._f is None:
+            return
+        if not self.size:
+            self.abort()
+            return
+        try:
+            self._f.close()
+            self._f = None
+            os.rename(self._tmp, self.cache._filename(self.key))
+            self._tmp = None
+        except (IOError, OSError), e:
+            # concurrent writers store the same content, losing is fine
+            self.cache.log.debug('MasterTickets: Can not store render cache entry %s: %s',
+                                 self.key, e)
+            self.abort()
+            return
+        self.cache.evict()
+
+    def abort(self):
+        """Discard the written data."""
+        if self._f is not None:
+            self._f.close()
+            self._f = None
+        if self._tmp is not None:
+            try:
+                os.unlink(self._tmp)
+            except OSError:
+                pass
+            self._tmp = None
+
+
+class _RenderJob(object):
+    """A render in progress, shared by identical requests."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class DepgraphRenderScheduler(Component):
+    """Bounds the number of concurrently running graph renders.
+
+    Renders wait for one of `render_workers` slots, requests beyond
+    `render_queue_size` waiting renders are refused. Concurrent renders
+    of the same graph are run only once.
+    """
+
+    max_workers = IntOption('mastertickets', 'render_workers', default=2,
+        doc='Maximum number of dependency graphs rendered at the same time.')
+    max_queue = IntOption('mastertickets', 'render_queue_size', default=8,
+        doc='Maximum number of renders waiting for a free worker, further requests are refused.')
+    timeout = IntOption('mastertickets', 'render_timeout', default=30,
+        doc='Seconds after which render processes are killed (0 for no limit).')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(max(self.max_workers, 1))
+        self._waiting = 0
+        self._jobs = {} # {key: _RenderJob}
+
+    def run(self, key, render):
+        """Return the result of `render()`, sharing it with concurrent
+        calls for the same `key`.
+
+        Raise `HTTPServiceUnavailable` if too many renders are waiting.
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            owner = job is None
+            if owner:
+                job = self._jobs[key] = _RenderJob()
+
+        if not owner:
+            job.done.wait()
+            if job.error is not None:
+                raise job.error
+            return job.result
+
+        try:
+            self.acquire()
+            try:
+                job.result = render()
+            finally:
+                self.release()
+        except Exception, e:
+            job.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._jobs[key]
+            job.done.set()
+        return job.result
+
+    def acquire(self):
+        """Wait for a free render slot, to be given back with `release`.
+
+        Raise `HTTPServiceUnavailable` if too many renders are waiting.
+        """
+        if self._slots.acquire(False):
+            return
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                self.log.warning('MasterTickets: Render queue is full, refusing request')
+                raise HTTPServiceUnavailable(_('Too many dependency graphs are being '
+                                               'rendered, please try again later.'))
+            self._waiting += 1
+        try:
+            self._slots.acquire()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def release(self):
+        self._slots.release()
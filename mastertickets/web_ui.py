@@ -1,31 +1,36 @@
 # Copyright (c) 2007 Noah Kantrowitz
 # Copyright (c) 2012 Aleksey A. Porfirov
 
-import subprocess
+import hashlib
+import os
 import re
+import tempfile
 import textwrap
-import itertools
 from functools import partial
 
 from pkg_resources import resource_filename
 from genshi.builder import tag
 
 from trac.core import *
-from trac.web.api import IRequestHandler, IRequestFilter, ITemplateStreamFilter
+from trac.web.api import IRequestHandler, IRequestFilter, ITemplateStreamFilter, \
+                         RequestDone
 from trac.web.chrome import ITemplateProvider, INavigationContributor, \
                             add_ctxtnav
 from trac.ticket.api import ITicketManipulator
-from trac.ticket.model import Ticket, Milestone
+from trac.ticket.model import Milestone
 from trac.ticket.query import Query
-from trac.config import Option, BoolOption, ChoiceOption, ListOption
-from trac.resource import Resource, ResourceNotFound, get_resource_url, get_real_resource_from_url
+from trac.config import Option, BoolOption, ChoiceOption, IntOption, ListOption
+from trac.resource import Resource, get_resource_url, get_real_resource_from_url
 from trac.util import to_unicode
+from trac.util.datefmt import from_utimestamp, http_date
 from trac.util.text import shorten_line
 
 from trac.project.api import ProjectManagement
 
 import graphviz
-from model import TicketLinks
+from render import DepgraphRenderCache, DepgraphRenderScheduler
+from model import TicketLinks, TicketSummary, get_links_generation, \
+                  get_project_changetime, has_links, unclosed_tickets
 from api import MasterTicketsSystem, _
 
 
@@ -64,11 +69,31 @@ class MasterTicketsModule(Component):
                                doc='Check for unclosed blocking tickets when performing specified actions',
                                switcher=True)
 
+    query_link_status = BoolOption('mastertickets', 'query_link_status', default=False,
+        doc='Render ticket IDs in query and report results as links styled by ticket status')
+
+    walk_depth = IntOption('mastertickets', 'walk_depth', default=0,
+        doc='Default number of dependency levels shown in ticket and milestone graphs (0 for unlimited)')
+    walk_direction = ChoiceOption('mastertickets', 'walk_direction', choices=['both', 'up', 'down'],
+        doc='Default direction of dependencies shown in ticket and milestone graphs: both, up (blocking tickets) or down (blocked tickets)')
+    walk_max_nodes = IntOption('mastertickets', 'walk_max_nodes', default=0,
+        doc='Default maximum number of tickets shown in ticket and milestone graphs (0 for unlimited)')
+
+    show_isolated = BoolOption('mastertickets', 'show_isolated', default=True,
+        doc='Show tickets without dependencies in the project dependency graph')
+
+    check_transitive = BoolOption('mastertickets', 'check_transitive', default=False,
+        doc='Also check tickets indirectly blocking the ticket when performing check actions')
+
     fields = set(['blocking', 'blockedby'])
+    MIME_TYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
     IMAGE_RE = re.compile(r'depgraph\.([a-z]{3,5})$')
+    LINKS_SPLIT_RE = re.compile(r'([;,\s]+)')
 
     def __init__(self):
-        MasterTicketsSystem(self.env)
+        self.mt_system = MasterTicketsSystem(self.env)
+        self.render_cache = DepgraphRenderCache(self.env)
+        self.render_scheduler = DepgraphRenderScheduler(self.env)
         self.pm = ProjectManagement(self.env)
 
     # INavigationContributor
@@ -94,10 +119,8 @@ class MasterTicketsModule(Component):
                 return template, data, content_type
             tkt = data['ticket']
             self.pm.check_component_enabled(self, pid=tkt.pid)
-            links = TicketLinks(self.env, tkt)
-
             # Add link to depgraph if needed
-            if links:
+            if has_links(self.env, tkt.id):
                 add_ctxtnav(req, _('Depgraph'), req.href.depgraph(get_resource_url(self.env, tkt.resource)))
 
             for change in data.get('changes', {}):
@@ -153,11 +176,14 @@ class MasterTicketsModule(Component):
         if filename in ["report_view.html", "query_results.html", "ticket.html", "query.html"]:
             # For ticket.html
             if 'fields' in data and isinstance(data['fields'], list):
-                self.pm.check_component_enabled(self, pid=data['ticket'].pid)
+                ticket = data['ticket']
+                self.pm.check_component_enabled(self, pid=ticket.pid)
+                ticket_map = self._fetch_link_tickets(req, [ticket[f] for f in self.fields])
                 for field in data['fields']:
                     for f in self.fields:
-                        if field['name'] == f and data['ticket'][f]:
-                            field['rendered'] = self._link_tickets(req, data['ticket'][f], fetch_tickets=True)
+                        if field['name'] == f and ticket[f]:
+                            field['rendered'] = self._link_tickets(req, ticket[f], ticket_map)
+            cells = [] # [(container, key), ...] of link field values to render
             # For query_results.html and query.html
             if 'groups' in data and isinstance(data['groups'], list):
                 self.pm.check_component_enabled(self, syllabus_id=data['query'].syllabus_id)
@@ -165,18 +191,20 @@ class MasterTicketsModule(Component):
                     for ticket in tickets:
                         for f in self.fields:
                             if f in ticket:
-                                ticket[f] = self._link_tickets(req, ticket[f])
+                                cells.append((ticket, f))
             # For report_view.html
             if 'row_groups' in data and isinstance(data['row_groups'], list):
                 self.pm.check_component_enabled(self, syllabus_id=data['report']['syllabus_id'])
                 for group, rows in data['row_groups']:
                     for row in rows:
                         if 'cell_groups' in row and isinstance(row['cell_groups'], list):
-                            for cells in row['cell_groups']:
-                                for cell in cells:
+                            for cells_ in row['cell_groups']:
+                                for cell in cells_:
                                     # If the user names column in the report differently (blockedby AS "blocked by") then this will not find it
                                     if cell.get('header', {}).get('col') in self.fields:
-                                        cell['value'] = self._link_tickets(req, cell['value'])
+                                        cells.append((cell, 'value'))
+            if cells:
+                self._render_link_cells(req, cells)
         return stream
 
     # ITicketManipulator
@@ -193,10 +221,10 @@ class MasterTicketsModule(Component):
         syllabus_id = ticket.syllabus_id
         actions = self.check_actions.syllabus(syllabus_id)
         if action['alias'] in actions:
-            links = TicketLinks(self.env, ticket)
-            for i in links.blocked_by:
-                if Ticket(self.env, i)['status'] != 'closed':
-                    yield None, _('Ticket #%(id)s is blocking this ticket', id=i)
+            links = self.mt_system.prepare_links(ticket)
+            for i in sorted(unclosed_tickets(self.env, links.blocked_by,
+                                             self.check_transitive)):
+                yield None, _('Ticket #%(id)s is blocking this ticket', id=i)
 
     # ITemplateProvider
 
@@ -234,33 +262,16 @@ class MasterTicketsModule(Component):
 
         #list of tickets to generate the depgraph for
         tkt_ids=[]
+        links = None
 
         if is_full_graph:
             # depgraph for full project
             # cluster by milestone
             self.pm.check_component_enabled(self, pid=cur_pid)
-            db = self.env.get_read_db()
-            cursor = db.cursor()
-            if with_clusters:
-                q = '''
-                    SELECT milestone, id
-                    FROM ticket
-                    WHERE project_id=%s
-                    ORDER BY milestone, id
-                '''
-            else:
-                q = '''
-                    SELECT id
-                    FROM ticket
-                    WHERE project_id=%s
-                    ORDER BY id
-                '''
-            cursor.execute(q, (cur_pid,))
-            rows = cursor.fetchall()
-            if with_clusters:
-                tkt_ids = rows
-            else:
-                tkt_ids = [r[0] for r in rows]
+            self._check_modified(req, cur_pid)
+            links = TicketLinks.load_project(self.env, cur_pid,
+                                             linked_only=not self.show_isolated)
+            tkt_ids = sorted(links)
         else:
             # degraph for resource
             resource = get_real_resource_from_url(self.env, path_info, req.args)
@@ -270,6 +281,7 @@ class MasterTicketsModule(Component):
             self.pm.check_component_enabled(self, pid=res_pid)
             if res_pid != cur_pid:
                 self.pm.redirect_to_project(req, res_pid)
+            self._check_modified(req, res_pid)
 
             is_milestone = isinstance(resource, Milestone)
             #Urls to generate the depgraph for a ticket is /depgraph/ticketnum
@@ -284,6 +296,15 @@ class MasterTicketsModule(Component):
                 ticket = resource
                 tkt_ids = [ticket.id]
 
+        #depth, direction and max_nodes bound the walk around the tickets
+        depth = direction = max_nodes = None
+        if not is_full_graph:
+            depth = self._int_arg(req, 'depth', self.walk_depth)
+            direction = req.args.get('direction')
+            if direction not in ('both', 'up', 'down'):
+                direction = self.walk_direction
+            max_nodes = self._int_arg(req, 'max_nodes', self.walk_max_nodes)
+
         #the summary argument defines whether we place the ticket id or
         #it's summary in the node's label
         label_summary=0
@@ -291,7 +312,9 @@ class MasterTicketsModule(Component):
             label_summary=int(req.args.get('summary'))
 
         clustering = is_full_graph and with_clusters
-        g = self._build_graph(req, tkt_ids, label_summary=label_summary, with_clusters=clustering)
+        g = self._build_graph(req, tkt_ids, label_summary=label_summary, with_clusters=clustering,
+                              links=links, max_depth=depth or None, max_nodes=max_nodes or None,
+                              direction=direction or 'both')
         if is_img or img_format:
             if img_format == 'text':
                 #in case g.__str__ returns unicode, we need to convert it in ascii
@@ -300,33 +323,26 @@ class MasterTicketsModule(Component):
                 import pprint
                 req.send(
                     pprint.pformat(
-                        [TicketLinks(self.env, tkt_id) for tkt_id in tkt_ids]
+                        sorted((links or TicketLinks.load_many(self.env, tkt_ids)).values(),
+                               key=lambda link: link.tkt_id)
                         ),
                     'text/plain')
-            elif img_format == 'svg':
-                req.send(g.render(self.dot_path, img_format), 'image/svg+xml')
-            elif img_format is not None:
-                req.send(g.render(self.dot_path, img_format), 'text/plain')
-
-            if self.use_gs:
-                ps = g.render(self.dot_path, 'ps2')
-                gs = subprocess.Popen([self.gs_path, '-q', '-dTextAlphaBits=4', '-dGraphicsAlphaBits=4', '-sDEVICE=png16m', '-sOutputFile=%stdout%', '-'],
-                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                img, err = gs.communicate(ps)
-                if err:
-                    self.log.debug('MasterTickets: Error from gs: %s', err)
+            elif img_format == 'json':
+                self._send_json(req, g)
             else:
-                img = g.render(self.dot_path)
-            req.send(img, 'image/png')
+                self._send_graph(req, g, img_format)
         else:
             data = {
                 'graph': g,
-                'graph_render': partial(g.render, self.dot_path),
+                'graph_render': partial(self._render_graph, g),
                 'use_gs': self.use_gs,
                 'full_graph': is_full_graph,
                 'img_format': self.default_format,
                 'summary': label_summary,
                 'with_clusters': with_clusters,
+                'depth': depth,
+                'direction': direction,
+                'max_nodes': max_nodes,
             }
 
             if is_full_graph:
@@ -345,11 +361,55 @@ class MasterTicketsModule(Component):
                 rsc_url = get_resource_url(self.env, resource)
 
             data['img_url'] = req.href.depgraph(rsc_url, 'depgraph.%s' % self.default_format,
-                                                summary=g.label_summary, with_clusters=int(with_clusters))
+                                                summary=g.label_summary, with_clusters=int(with_clusters),
+                                                depth=depth, direction=direction, max_nodes=max_nodes)
 
             return 'depgraph.html', data, None
 
-    def _build_graph(self, req, tkt_ids, label_summary=0, with_clusters=False):
+    def _int_arg(self, req, name, default):
+        """Return the non-negative integer argument `name`, or `default`
+        if it is missing or empty (as submitted by the depgraph form)."""
+        if not req.args.get(name, '').strip():
+            return default
+        return req.args.getint(name, default, min=0)
+
+    def _check_modified(self, req, pid):
+        """Answer the request with 304 Not Modified if the client has an
+        up to date copy of the depgraph of project `pid`.
+
+        The validator combines the last change of the tickets involved,
+        the generation of the link table, the request arguments and the
+        graph options.
+        """
+        db = self.env.get_read_db()
+        changetime = get_project_changetime(db, pid)
+        options = (req.path_info, sorted(req.args.items()), req.locale,
+                   get_links_generation(db), self.graph_direction,
+                   self.closed_color, self.opened_color, self.bad_closed_color,
+                   self.bad_closed_resolutions.syllabus(req.data['syllabus_id']),
+                   self.default_format, self.use_gs, self.show_isolated,
+                   self.walk_depth, self.walk_direction, self.walk_max_nodes)
+        extra = hashlib.sha1(repr(options)).hexdigest()
+        lastmod = from_utimestamp(changetime)
+        if not req.get_header('If-None-Match') and \
+                req.get_header('If-Modified-Since') == http_date(lastmod):
+            req.send_response(304)
+            req.send_header('Content-Length', 0)
+            req.end_headers()
+            raise RequestDone
+        req.send_header('Last-Modified', http_date(lastmod))
+        req.check_modified(lastmod, extra)
+
+    def _build_graph(self, req, tkt_ids, label_summary=0, with_clusters=False, links=None,
+                     max_depth=None, max_nodes=None, direction='both'):
+        """Build the dependency graph of `tkt_ids`.
+
+        `links` is a dict `{tkt_id: TicketLinks}` of all tickets to show,
+        tickets reachable from `tkt_ids` are walked if it is `None`, no
+        further than `max_depth` levels in `direction` and up to `max_nodes`
+        tickets. Links to tickets cut off by these limits are collapsed
+        into "+N more" nodes.
+        """
         g = graphviz.Graph()
         g.label_summary = label_summary
 
@@ -390,63 +450,255 @@ class MasterTicketsModule(Component):
             node['tooltip'] = summary.replace('\\n', ' &#10;')
             return node
 
-        ticket_cache = {}
+        bc_resolutions = self.bad_closed_resolutions.syllabus(req.data['syllabus_id'])
+        capped = False
+        if links is None:
+            links = TicketLinks.walk_tickets(self.env, tkt_ids, max_depth=max_depth,
+                                             max_nodes=max_nodes, direction=direction)
+            capped = bool(max_depth or max_nodes) or direction != 'both'
+        else:
+            links = links.itervalues()
+        links = sorted(links, key=lambda link: link.tkt.id)
+        shown = set(link.tkt.id for link in links)
+
+        def create_more_node(tkt, kind, count):
+            more = g[u'more%s_%s' % (tkt.id, kind)]
+            more.update({
+                'label': _('+%(count)s more', count=count),
+                'shape': 'box',
+                'style': 'dashed',
+                'URL': req.href.depgraph(get_resource_url(self.env,
+                                         Resource('ticket', tkt.id, pid=tkt.pid)),
+                                         summary=label_summary, depth=max_depth,
+                                         direction=direction, max_nodes=max_nodes),
+            })
+            return more
 
         if with_clusters:
-            milestone_tkt_ids = sorted(tkt_ids)
-            tkt_ids = []
-            tickets = {} # { <milestone_name or None>: (<cluster or graph>, <tkt_ids list>), ... }
-            ticket_milestones = {} # { <tkt_id>: <milestone> }
-            m_idx = 0
-            for milestone, mtkt_ids in itertools.groupby(milestone_tkt_ids, lambda p: p[0]):
-                ids = [p[1] for p in mtkt_ids]
-                if milestone:
-                    m_idx += 1
-                    url = req.href.depgraph(get_resource_url(self.env,
-                                            Resource('milestone', milestone, pid=req.data['project_id'])))
-                    tickets[milestone] = (g.create_cluster(
-                            u'cluster%s' % m_idx,
-                            label=q(milestone),
-                            href=url, target='_blank'),
-                                          ids)
-                else:
-                    milestone = None
-                    tickets[None] = (g, ids)
-                tkt_ids.extend(ids)
-                for tkt_id in ids:
-                    ticket_milestones[tkt_id] = milestone
+            # tickets of other projects are kept out of milestone clusters
+            pid = req.data['project_id']
+            ticket_milestones = dict((link.tkt.id, link.tkt.pid == pid and link.tkt['milestone'] or None)
+                                     for link in links) # { <tkt_id>: <milestone> }
+            clusters = {None: g} # { <milestone_name or None>: <cluster or graph>, ... }
+            for m_idx, milestone in enumerate(sorted(set(ticket_milestones.itervalues()) - set([None]))):
+                url = req.href.depgraph(get_resource_url(self.env,
+                                        Resource('milestone', milestone, pid=pid)))
+                clusters[milestone] = g.create_cluster(
+                        u'cluster%s' % (m_idx + 1),
+                        label=q(milestone),
+                        href=url, target='_blank')
         else:
             # Init nodes for resource tickets on graph top
             for id in tkt_ids:
-                g[id]
+                if id in shown:
+                    g[id]
 
-        bc_resolutions = self.bad_closed_resolutions.syllabus(req.data['syllabus_id'])
-        links = TicketLinks.walk_tickets(self.env, tkt_ids, ticket_cache)
-        links = sorted(links, key=lambda link: link.tkt.id)
         for link in links:
             node = create_node(link.tkt)
 
             if with_clusters:
-                milestone_from = link.tkt['milestone'] or None
-                stor = tickets[milestone_from][0]
+                milestone_from = ticket_milestones[link.tkt.id]
+                stor = clusters[milestone_from]
                 stor[link.tkt.id] # include node
                 for n in link.blocking:
-                    milestone_to = ticket_milestones[n]
+                    milestone_to = ticket_milestones.get(n)
                     if milestone_from == milestone_to:
                         stor.add(node > stor[n]) # save edge in same cluster
                     else:
-                        g.add(node > tickets[milestone_to][0][n]) # save edge in global graph
+                        g.add(node > clusters[milestone_to][n]) # save edge in global graph
             else:
                 g[link.tkt.id]
+                hidden = 0
                 for n in link.blocking:
-                    g.add(node > g[n])
+                    if capped and n not in shown:
+                        hidden += 1
+                    else:
+                        g.add(node > g[n])
+                if hidden:
+                    g.add(node > create_more_node(link.tkt, 'down', hidden))
+                if capped:
+                    hidden = len([n for n in link.blocked_by if n not in shown])
+                    if hidden:
+                        g.add(create_more_node(link.tkt, 'up', hidden) > node)
 
         return g
 
-    def _link_tickets(self, req, tickets, fetch_tickets=False):
+    def _render_graph(self, g, format='png'):
+        """Render graph `g` to `format`, reusing cached output of
+        identical graphs.
+        """
+        source = unicode(g)
+        key = self._render_key(source, format)
+        data = self.render_cache.get(key)
+        if data is None:
+            try:
+                data = self.render_scheduler.run(key,
+                    partial(self._run_render, g, source, key, format))
+            except graphviz.RenderTimeout, e:
+                self.log.warning('MasterTickets: Render timed out: %s', e)
+                raise TracError(_('Rendering the dependency graph took too long.'))
+        return data
+
+    def _send_json(self, req, g):
+        """Send the nodes and edges of graph `g` as JSON, for clients
+        laying the graph out themselves.
+        """
+        req.send_response(200)
+        req.send_header('Content-Type', 'application/json; charset=utf-8')
+        req.end_headers()
+        for chunk in g.iter_json():
+            req.write(chunk)
+        raise RequestDone
+
+    def _send_graph(self, req, g, format):
+        """Send graph `g` rendered to `format`.
+
+        The output of the render processes is spooled to a temporary file
+        and stored in the render cache. Concurrent requests for the same
+        graph share one render and send the cached file. Render slots and
+        timeouts only cover the processes, not sending to the client.
+        """
+        source = unicode(g)
+        key = self._render_key(source, format)
+
+        f = self.render_cache.open(key)
+        if f is None:
+            spool = []
+            def render():
+                spool.append(self._render_to_file(g, key, format))
+            try:
+                self.render_scheduler.run(key, render)
+                if spool: # rendered by this request
+                    f = spool[0]
+                else: # rendered by a concurrent request
+                    f = self.render_cache.open(key)
+                if f is None: # the shared output did not make it to the cache
+                    self.render_scheduler.acquire()
+                    try:
+                        f = self._render_to_file(g, key, format)
+                    finally:
+                        self.render_scheduler.release()
+            except graphviz.RenderTimeout, e:
+                self.log.warning('MasterTickets: Render timed out: %s', e)
+                raise TracError(_('Rendering the dependency graph took too long.'))
+
+        try:
+            req.send_response(200)
+            req.send_header('Content-Type', self.MIME_TYPES.get(format, 'text/plain'))
+            req.send_header('Content-Length', os.fstat(f.fileno()).st_size)
+            req.end_headers()
+            for chunk in iter(partial(f.read, graphviz.CHUNK_SIZE), ''):
+                req.write(chunk)
+        finally:
+            f.close()
+        raise RequestDone
+
+    def _render_to_file(self, g, key, format):
+        """Render graph `g` to `format` into a temporary file, also
+        storing the output in the render cache.
+
+        Return the file, positioned at its start.
+        """
+        timeout = self.render_scheduler.timeout
+        errors = None
+        if format == 'png' and self.use_gs:
+            errors = tempfile.TemporaryFile()
+            chunks = g.iter_render(self.dot_path, 'ps2',
+                [[self.gs_path, '-q', '-dTextAlphaBits=4', '-dGraphicsAlphaBits=4', '-sDEVICE=png16m', '-sOutputFile=%stdout%', '-']],
+                timeout, stderr=errors)
+        else:
+            chunks = g.iter_render(self.dot_path, format, timeout=timeout)
+        f = tempfile.TemporaryFile()
+        writer = self.render_cache.writer(key)
+        try:
+            for chunk in chunks:
+                f.write(chunk)
+                if writer is not None:
+                    writer.write(chunk)
+            if writer is not None:
+                writer.commit()
+                writer = None
+            f.seek(0)
+        except:
+            f.close()
+            raise
+        finally:
+            if writer is not None:
+                writer.abort()
+            chunks.close()
+            if errors is not None:
+                errors.seek(0)
+                err = errors.read()
+                errors.close()
+                if err:
+                    self.log.debug('MasterTickets: Error from gs: %s', err)
+        return f
+
+    def _render_key(self, source, format):
+        if format == 'png' and self.use_gs:
+            tools = (self.dot_path, self.gs_path)
+        else:
+            tools = (self.dot_path,)
+        return self.render_cache.get_key(source, format, *tools)
+
+    def _run_render(self, g, source, key, format):
+        timeout = self.render_scheduler.timeout
+        if format == 'cmapx' and not self.use_gs and self.render_cache.enabled:
+            # the image map page is followed by the image request,
+            # lay the graph out once for both
+            outputs = g.render_many(self.dot_path, ('cmapx', 'png'), timeout)
+            self.render_cache.put(self._render_key(source, 'png'), outputs['png'])
+            data = outputs['cmapx']
+        else:
+            data = g.render(self.dot_path, format, timeout)
+        self.render_cache.put(key, data)
+        return data
+
+    def _render_link_cells(self, req, cells):
+        """Render link field values of query and report result `cells`.
+
+        Rendered fragments are memoized by the raw value, as the same
+        values repeat a lot. With `query_link_status` enabled, tickets of
+        all cells are fetched at once to render links with status classes.
+        """
+        ticket_map = None
+        if self.query_link_status:
+            ticket_map = self._fetch_link_tickets(req,
+                [container[key] for container, key in cells
+                 if isinstance(container[key], basestring)])
+        memo = {}
+        for container, key in cells:
+            value = container[key]
+            if not isinstance(value, basestring):
+                container[key] = self._link_tickets(req, value, ticket_map)
+                continue
+            if value not in memo:
+                memo[value] = self._link_tickets(req, value, ticket_map)
+            container[key] = memo[value]
+
+    def _fetch_link_tickets(self, req, values):
+        """Prefetch tickets referenced in link field `values`.
+
+        Tickets are loaded with one projection query. Return a dict
+        `{tkt_id: TicketSummary}` of the tickets the user may view.
+        """
+        ids = set()
+        for value in values:
+            ids.update(int(n) for n in self.mt_system.NUMBERS_RE.findall(value or ''))
+        tickets = TicketSummary.load_many(self.env, ids)
+        perm = req.perm
+        return dict((tkt_id, tkt) for tkt_id, tkt in tickets.iteritems()
+                    if 'TICKET_VIEW' in perm(Resource('ticket', tkt_id, pid=tkt.pid)))
+
+    def _link_tickets(self, req, tickets, ticket_map=None):
+        """Render a link field value.
+
+        IDs found in `ticket_map` (see `_fetch_link_tickets`) are rendered
+        as links to the tickets.
+        """
         items = []
 
-        for i, word in enumerate(re.split(r'([;,\s]+)', tickets or '')):
+        for i, word in enumerate(self.LINKS_SPLIT_RE.split(tickets or '')):
             if i % 2:
                 items.append(word)
             elif word:
@@ -456,19 +708,15 @@ class MasterTicketsModule(Component):
                     return None
                 word = '#%s' % word
 
-                if fetch_tickets:
-                    try:
-                        ticket = Ticket(self.env, ticketid)
-                        if 'TICKET_VIEW' in req.perm(ticket.resource):
-                            word = \
-                                tag.a(
-                                    '#%s' % ticket.id,
-                                    class_=ticket['status'],
-                                    href=req.href.ticket(int(ticket.id)),
-                                    title=shorten_line(ticket['summary'])
-                                )
-                    except ResourceNotFound:
-                        pass
+                if ticket_map is not None and ticketid in ticket_map:
+                    ticket = ticket_map[ticketid]
+                    word = \
+                        tag.a(
+                            '#%s' % ticket.id,
+                            class_=ticket.status,
+                            href=req.href.ticket(ticket.id),
+                            title=shorten_line(ticket.summary)
+                        )
 
                 items.append(word)
 
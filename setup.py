@@ -52,6 +52,8 @@ setup(
         'trac.plugins': [
             'mastertickets.web_ui = mastertickets.web_ui',
             'mastertickets.api = mastertickets.api',
+            'mastertickets.admin = mastertickets.admin',
+            'mastertickets.render = mastertickets.render',
         ]
     },
 